@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк распределения подарков (gift_solver) на больших мероприятиях.
+
+Запуск: python bench_gift_solver.py [число участников]
+"""
+
+import random
+import sys
+import time
+
+from gift_solver import NoValidAssignment, solve_gift_assignments, validate_assignments
+
+
+def build_case(n: int, rng: random.Random):
+    participant_ids = list(range(1, n + 1))
+
+    # Хозяйства по 1-4 человека и синдикаты примерно по 200 человек
+    households = {}
+    household = 0
+    i = 0
+    while i < n:
+        size = rng.randint(1, 4)
+        for participant_id in participant_ids[i:i + size]:
+            households[participant_id] = household
+        household += 1
+        i += size
+    syndicates = {participant_id: rng.randrange(max(1, n // 200)) for participant_id in participant_ids if rng.random() < 0.7}
+
+    # Пары прошлогоднего мероприятия и немного явных исключений
+    previous = participant_ids[:]
+    rng.shuffle(previous)
+    history = [(previous[k], previous[(k + 1) % n]) for k in range(n)]
+    explicit = [(rng.choice(participant_ids), rng.choice(participant_ids)) for _ in range(n // 20)]
+    return participant_ids, history + explicit, [households, syndicates]
+
+
+def run(n: int, seed: int = 1):
+    rng = random.Random(seed)
+    participant_ids, pairs, groups = build_case(n, rng)
+    started = time.perf_counter()
+    assignments = solve_gift_assignments(participant_ids, pairs, groups, seed=seed)
+    elapsed = time.perf_counter() - started
+    valid = validate_assignments(participant_ids, assignments, pairs, groups)
+    print(f"{n:>7} участников, {len(pairs):>7} пар-исключений: {elapsed:.2f} с, корректно: {valid}")
+    return valid
+
+
+def main():
+    sizes = [int(sys.argv[1])] if len(sys.argv) > 1 else [1000, 10000, 100000]
+    ok = all(run(n) for n in sizes)
+
+    # Недопустимый случай: одна группа больше половины участников
+    try:
+        solve_gift_assignments(list(range(10)), groups=[{i: "A" for i in range(6)}])
+        print("Ошибка: недопустимый случай не обнаружен")
+        ok = False
+    except NoValidAssignment as e:
+        print(f"Недопустимый случай обнаружен: {e.reason}")
+
+    # Недопустимый случай, который находит только точная проверка
+    try:
+        solve_gift_assignments([1, 2, 3, 4], forbidden_pairs=[(1, 2), (1, 3), (2, 3)])
+        print("Ошибка: недопустимый случай не обнаружен")
+        ok = False
+    except NoValidAssignment as e:
+        print(f"Недопустимый случай обнаружен: {e.reason}")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Распределение получателей подарков с ограничениями.
+
+Ищет цикл «даритель -> получатель» по всем участникам, в котором нет запрещенных пар:
+- явно запрещенные пары (в обе стороны);
+- участники с одинаковым значением атрибута (одно хозяйство, один синдикат и т.п.).
+
+Случайный цикл почти всегда содержит лишь несколько запрещенных ребер, поэтому они исправляются
+локальными перестановками участников (ожидаемо O(1) попыток на ребро) — время почти линейное.
+Если локальный поиск не справился, для небольших мероприятий точно проверяется существование
+распределения (паросочетание Хопкрофта — Карпа); иначе сообщается, что распределение не найдено.
+"""
+
+import random
+from collections import Counter, deque
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+# До этого числа участников при неудаче локального поиска выполняется точная проверка (граф O(n^2))
+EXACT_SEARCH_LIMIT = 1500
+
+
+class NoValidAssignment(Exception):
+    """Распределение с заданными ограничениями не существует или не найдено"""
+
+    def __init__(self, reason: str, proven: bool = True):
+        super().__init__(reason)
+        self.reason = reason
+        self.proven = proven  # True — доказано, что распределения нет
+
+
+class _Constraints:
+    """Ограничения в индексах участников 0..n-1"""
+
+    def __init__(self, participant_ids: List[int], forbidden_pairs: Iterable[Tuple[int, int]], groups: Iterable[Dict[int, Hashable]]):
+        self.n = len(participant_ids)
+        index = {participant_id: i for i, participant_id in enumerate(participant_ids)}
+        n = self.n
+
+        self.pairs = set()
+        for first, second in forbidden_pairs:
+            a, b = index.get(first), index.get(second)
+            if a is None or b is None or a == b:
+                continue
+            self.pairs.add(a * n + b)
+            self.pairs.add(b * n + a)
+
+        # Для каждого правила — номер группы участника (-1 — без группы)
+        self.labels = []
+        self.group_sizes = []
+        for group_map in groups:
+            codes = {}
+            labels = [-1] * n
+            for participant_id, value in group_map.items():
+                i = index.get(participant_id)
+                if i is None or value is None:
+                    continue
+                labels[i] = codes.setdefault(value, len(codes))
+            self.labels.append(labels)
+            self.group_sizes.append(Counter(label for label in labels if label >= 0))
+
+    def forbidden(self, giver: int, receiver: int) -> bool:
+        if giver == receiver:
+            return True
+        if self.pairs and giver * self.n + receiver in self.pairs:
+            return True
+        for labels in self.labels:
+            label = labels[giver]
+            if label >= 0 and label == labels[receiver]:
+                return True
+        return False
+
+
+def _check_necessary_conditions(constraints: _Constraints):
+    n = constraints.n
+    for sizes in constraints.group_sizes:
+        if sizes:
+            largest = max(sizes.values())
+            # Каждый участник группы дарит за ее пределы, значит вне группы нужно не меньше людей
+            if largest > n - largest:
+                raise NoValidAssignment(
+                    f"Группа из {largest} участников занимает больше половины из {n}: им некому дарить вне группы"
+                )
+    if constraints.pairs:
+        excluded = Counter(pair // n for pair in constraints.pairs)
+        for giver, count in excluded.items():
+            if count >= n - 1:
+                raise NoValidAssignment("Одному из участников запрещены все получатели")
+
+
+def _interleaved_order(constraints: _Constraints, rng: random.Random) -> List[int]:
+    """Начальный цикл, где соседи из разных групп самого «тесного» правила
+
+    Группы по убыванию размера раскладываются сначала по четным позициям, затем по нечетным:
+    если ни одна группа не больше половины участников, соседей из одной группы не будет.
+    """
+    n = constraints.n
+    rule = max(range(len(constraints.labels)), key=lambda k: max(constraints.group_sizes[k].values(), default=0))
+    labels = constraints.labels[rule]
+    members = {}
+    for i in range(n):
+        # Участник без группы — сам себе группа
+        members.setdefault(labels[i] if labels[i] >= 0 else -1 - i, []).append(i)
+    buckets = list(members.values())
+    rng.shuffle(buckets)
+    buckets.sort(key=len, reverse=True)
+    sequence = []
+    for bucket in buckets:
+        rng.shuffle(bucket)
+        sequence.extend(bucket)
+    order = [0] * n
+    positions = list(range(0, n, 2)) + list(range(1, n, 2))
+    for position, participant in zip(positions, sequence):
+        order[position] = participant
+    return order
+
+
+def _repair_cycle(order: List[int], constraints: _Constraints, rng: random.Random, max_steps: int) -> bool:
+    """Убирает запрещенные ребра цикла перестановками участников; True — цикл допустим"""
+    n = len(order)
+    forbidden = constraints.forbidden
+
+    def bad(k: int) -> bool:
+        return forbidden(order[k], order[(k + 1) % n])
+
+    bad_edges = {k for k in range(n) if bad(k)}
+    steps = 0
+    while bad_edges and steps < max_steps:
+        steps += 1
+        k = bad_edges.pop()
+        if not bad(k):
+            continue
+        # Меняем получателя запрещенного ребра со случайным участником
+        p = (k + 1) % n
+        q = rng.randrange(n)
+        if q == p:
+            bad_edges.add(k)
+            continue
+        affected = {(p - 1) % n, p, (q - 1) % n, q}
+        before = sum(bad(x) for x in affected)
+        order[p], order[q] = order[q], order[p]
+        after = sum(bad(x) for x in affected)
+        if after > before:
+            order[p], order[q] = order[q], order[p]
+            bad_edges.add(k)
+            continue
+        # Равноценные перестановки тоже принимаем, чтобы не застревать на плато
+        for x in affected:
+            if bad(x):
+                bad_edges.add(x)
+            else:
+                bad_edges.discard(x)
+    return not bad_edges
+
+
+def _exact_cover(constraints: _Constraints) -> Optional[List[int]]:
+    """Точный поиск: совершенное паросочетание дарители -> получатели (Хопкрофт — Карп)
+
+    Возвращает получателя для каждого дарителя (распределение может состоять из нескольких циклов)
+    или None, если распределения не существует.
+    """
+    n = constraints.n
+    adjacency = [[r for r in range(n) if not constraints.forbidden(g, r)] for g in range(n)]
+    match_giver = [-1] * n
+    match_receiver = [-1] * n
+    infinity = n + 1
+
+    while True:
+        # BFS: слои от свободных дарителей
+        distance = [infinity] * n
+        queue = deque()
+        for g in range(n):
+            if match_giver[g] == -1:
+                distance[g] = 0
+                queue.append(g)
+        found = False
+        while queue:
+            g = queue.popleft()
+            for r in adjacency[g]:
+                other = match_receiver[r]
+                if other == -1:
+                    found = True
+                elif distance[other] == infinity:
+                    distance[other] = distance[g] + 1
+                    queue.append(other)
+        if not found:
+            break
+
+        # DFS по слоям (итеративно, без рекурсии)
+        for start in range(n):
+            if match_giver[start] != -1:
+                continue
+            stack = [(start, iter(adjacency[start]))]
+            path = []
+            while stack:
+                g, neighbours = stack[-1]
+                advanced = False
+                for r in neighbours:
+                    other = match_receiver[r]
+                    if other == -1:
+                        path.append((g, r))
+                        for giver, receiver in path:
+                            match_giver[giver] = receiver
+                            match_receiver[receiver] = giver
+                        stack = []
+                        advanced = True
+                        break
+                    if distance[other] == distance[g] + 1:
+                        path.append((g, r))
+                        stack.append((other, iter(adjacency[other])))
+                        advanced = True
+                        break
+                if not advanced:
+                    distance[g] = infinity
+                    stack.pop()
+                    if path:
+                        path.pop()
+
+    if any(receiver == -1 for receiver in match_giver):
+        return None
+    return match_giver
+
+
+def solve_gift_assignments(
+    participant_ids: List[int],
+    forbidden_pairs: Iterable[Tuple[int, int]] = (),
+    groups: Iterable[Dict[int, Hashable]] = (),
+    seed: Optional[int] = None,
+    max_restarts: int = 5,
+) -> List[Tuple[int, int]]:
+    """Возвращает пары (даритель, получатель): каждый участник дарит и получает ровно один подарок
+
+    forbidden_pairs — запрещенные пары участников (в обе стороны);
+    groups — правила «одинаковый атрибут»: словари участник -> значение, участники с равным значением
+    не дарят друг другу (None означает «без группы»).
+    Бросает NoValidAssignment, если распределения нет.
+    """
+    participant_ids = list(dict.fromkeys(participant_ids))
+    n = len(participant_ids)
+    if n < 2:
+        raise NoValidAssignment("Недостаточно участников для назначения подарков")
+
+    constraints = _Constraints(participant_ids, forbidden_pairs, groups)
+    _check_necessary_conditions(constraints)
+    rng = random.Random(seed)
+
+    # Случайный цикл с локальной починкой. Если есть крупные группы (случайный цикл дал бы много
+    # запрещенных ребер) или случайный цикл не удалось починить — начинаем с чередования групп
+    largest_group = max((max(sizes.values(), default=0) for sizes in constraints.group_sizes), default=0)
+    interleave_from = 0 if largest_group * 4 > n else 1
+    for attempt in range(max_restarts):
+        if attempt < interleave_from or not constraints.labels:
+            order = list(range(n))
+            rng.shuffle(order)
+        else:
+            order = _interleaved_order(constraints, rng)
+        if _repair_cycle(order, constraints, rng, max_steps=20 * n + 10000):
+            return [
+                (participant_ids[order[k]], participant_ids[order[(k + 1) % n]])
+                for k in range(n)
+            ]
+
+    if n <= EXACT_SEARCH_LIMIT:
+        receivers = _exact_cover(constraints)
+        if receivers is None:
+            raise NoValidAssignment("Распределения с заданными ограничениями не существует")
+        order = list(range(n))
+        rng.shuffle(order)
+        return [(participant_ids[g], participant_ids[receivers[g]]) for g in order]
+
+    raise NoValidAssignment(
+        "Не удалось найти распределение с заданными ограничениями, попробуйте ослабить их",
+        proven=False
+    )
+
+
+def validate_assignments(participant_ids: List[int], assignments: List[Tuple[int, int]],
+                         forbidden_pairs: Iterable[Tuple[int, int]] = (),
+                         groups: Iterable[Dict[int, Hashable]] = ()) -> bool:
+    """Проверяет распределение: все дарят и получают по одному разу, запрещенных пар нет"""
+    participant_ids = list(dict.fromkeys(participant_ids))
+    if len(assignments) != len(participant_ids):
+        return False
+    givers = {giver for giver, _ in assignments}
+    receivers = {receiver for _, receiver in assignments}
+    if givers != set(participant_ids) or receivers != set(participant_ids):
+        return False
+    index = {participant_id: i for i, participant_id in enumerate(participant_ids)}
+    constraints = _Constraints(participant_ids, forbidden_pairs, groups)
+    return not any(constraints.forbidden(index[giver], index[receiver]) for giver, receiver in assignments)
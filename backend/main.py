@@ -1,26 +1,48 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Header
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer
-from fastapi.responses import Response, JSONResponse
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, func, text
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, func, text, event, or_, and_, select, delete, update, table, column, inspect, case, Index, union, literal
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker, Session, relationship, make_transient_to_detached, aliased, with_loader_criteria
 from pydantic import BaseModel, field_validator
 from datetime import datetime
 import os
+import socket
 import uuid
 import shutil
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from telegram_bot import TelegramBot, create_telegram_bot
+# Клиент API Telegram; имя TelegramBot занято моделью настроек бота
+from telegram_bot import TelegramBot as TelegramBotClient, create_telegram_bot
+from gift_solver import solve_gift_assignments, NoValidAssignment
 import requests
 import re
 import random
 from starlette.requests import Request
+from starlette.concurrency import run_in_threadpool
 from secrets import token_urlsafe, token_hex
 import hashlib
+import hmac
+import json
+import csv
+import io
+import threading
+import time
+import asyncio
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+try:
+    import fcntl
+except ImportError:  # Windows: ведущий процесс выбирается арендой строки в БД
+    fcntl = None
 
 # Environment detection
 IS_PYTHONANYWHERE = (
@@ -40,7 +62,17 @@ else:
     # Локальная разработка
     SQLALCHEMY_DATABASE_URL = "sqlite:///./santa.db"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# Режим пиковой нагрузки: записи регистраций идут через очередь и один пишущий поток пакетами
+REGISTRATION_SURGE_MODE = os.getenv("REGISTRATION_SURGE_MODE", "false").lower() == "true"
+REGISTRATION_BATCH_SIZE = int(os.getenv("REGISTRATION_BATCH_SIZE", "100"))
+REGISTRATION_FLUSH_INTERVAL_MS = float(os.getenv("REGISTRATION_FLUSH_INTERVAL_MS", "5"))
+REGISTRATION_QUEUE_DEPTH = int(os.getenv("REGISTRATION_QUEUE_DEPTH", "5000"))
+
+# В режиме пиковой нагрузки пул не используется: соединение SQLite дешево открыть, а запросы,
+# ожидающие пишущий поток, не должны ждать свободного соединения, удерживая event loop
+# (под нагрузкой это приводило к взаимной блокировке). Без него — обычный пул соединений
+engine_options = {"poolclass": NullPool} if REGISTRATION_SURGE_MODE else {}
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, **engine_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -60,13 +92,92 @@ os.makedirs(ICON_DIR, exist_ok=True)
 ALLOWED_ICON_TYPES = ["image/png", "image/jpeg", "image/jpg", "image/gif", "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon"]
 MAX_ICON_SIZE = 5 * 1024 * 1024  # 5MB
 
+# Кросс-серверный логин через GWars.io
+# Кэш недавно проверенных sign4: повторный вход по той же ссылке в течение дня не пересчитывает подписи
+CROSS_SERVER_REPLAY_CACHE_SIZE = int(os.getenv("CROSS_SERVER_REPLAY_CACHE_SIZE", "10000"))
+# Строгий режим: ссылку входа (sign4) можно использовать только один раз в сутки
+CROSS_SERVER_REJECT_REPLAY = os.getenv("CROSS_SERVER_REJECT_REPLAY", "false").lower() == "true"
+
 # JWT settings
 SECRET_KEY = "your-secret-key-here"
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 480  # 8 часов вместо 30 минут
+# Короткоживущий access-токен; длинная сессия держится на refresh-токене
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+# Кэш принципалов (пользователей, найденных по JWT)
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+PRINCIPAL_CACHE_MAX_SIZE = int(os.getenv("PRINCIPAL_CACHE_MAX_SIZE", "10000"))
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Стоимость bcrypt: при изменении хэши пересчитываются при следующем входе
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Пул потоков для bcrypt, чтобы хэширование не блокировало event loop
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_QUEUE_DEPTH = int(os.getenv("PASSWORD_HASH_QUEUE_DEPTH", "64"))
+
+# Кэш /events/current живет до ближайшей границы фаз мероприятия, но не дольше этого срока
+# (правка мероприятия на другом воркере станет видна не позже чем через него)
+CURRENT_EVENT_CACHE_MAX_SECONDS = int(os.getenv("CURRENT_EVENT_CACHE_MAX_SECONDS", "300"))
+
+# Планировщик фаз мероприятий (уведомления и хуки на границах preregistration/registration/event_start).
+# WSGI-адаптер PythonAnywhere не вызывает startup-хуки, там планировщик запускается
+# отдельной always-on задачей (run_event_scheduler.py)
+EVENT_SCHEDULER_ENABLED = os.getenv("EVENT_SCHEDULER_ENABLED", "false" if IS_PYTHONANYWHERE else "true").lower() == "true"
+# Файл блокировки: планировщик работает только в том воркере, который ее захватил
+EVENT_SCHEDULER_LOCK_FILE = os.getenv("EVENT_SCHEDULER_LOCK_FILE", "event_scheduler.lock")
+EVENT_SCHEDULER_RELOAD_SECONDS = int(os.getenv("EVENT_SCHEDULER_RELOAD_SECONDS", "300"))
+EVENT_SCHEDULER_NOTIFY = os.getenv("EVENT_SCHEDULER_NOTIFY", "true").lower() == "true"
+# За сколько часов до конца регистрации напомнить о нем (0 — не напоминать)
+EVENT_SCHEDULER_ENDING_SOON_HOURS = float(os.getenv("EVENT_SCHEDULER_ENDING_SOON_HOURS", "24"))
+# Генерировать назначения подарков сразу после закрытия регистрации
+EVENT_SCHEDULER_AUTO_ASSIGN = os.getenv("EVENT_SCHEDULER_AUTO_ASSIGN", "false").lower() == "true"
+
+# Ограничения при распределении подарков по умолчанию: не повторять пары последних N мероприятий
+# и не назначать друг другу участников с одинаковым адресом (одно хозяйство)
+GIFT_ASSIGNMENT_HISTORY_EVENTS = int(os.getenv("GIFT_ASSIGNMENT_HISTORY_EVENTS", "1"))
+GIFT_ASSIGNMENT_EXCLUDE_SAME_ADDRESS = os.getenv("GIFT_ASSIGNMENT_EXCLUDE_SAME_ADDRESS", "true").lower() == "true"
+# Сколько живет предпросмотр распределения (dry_run), который можно сохранить без пересчета
+GIFT_ASSIGNMENT_PREVIEW_TTL_SECONDS = int(os.getenv("GIFT_ASSIGNMENT_PREVIEW_TTL_SECONDS", "900"))
+
+# Удаленное мероприятие сразу скрывается, а его регистрации и назначения удаляются в фоне пачками
+EVENT_PURGE_BATCH_SIZE = int(os.getenv("EVENT_PURGE_BATCH_SIZE", "1000"))
+# Пауза между пачками, чтобы между ними успевали проходить другие записи
+EVENT_PURGE_PAUSE_MS = int(os.getenv("EVENT_PURGE_PAUSE_MS", "50"))
+
+# SSE-поток изменений мероприятия (/events/{id}/stream). WSGI-адаптер PythonAnywhere держит воркер
+# на все время потока, поэтому там поток по умолчанию выключен и фронтенд использует обычные запросы
+EVENT_STREAM_ENABLED = os.getenv("EVENT_STREAM_ENABLED", "false" if IS_PYTHONANYWHERE else "true").lower() == "true"
+# Лимит подключений на один воркер
+EVENT_STREAM_MAX_CONNECTIONS = int(os.getenv("EVENT_STREAM_MAX_CONNECTIONS", "500"))
+# Интервал keepalive; с этой же частотой поток сверяет счетчики с БД (изменения из других воркеров)
+EVENT_STREAM_KEEPALIVE_SECONDS = int(os.getenv("EVENT_STREAM_KEEPALIVE_SECONDS", "15"))
+# Сколько сообщений может накопиться у медленного клиента, прежде чем его отключат
+EVENT_STREAM_QUEUE_SIZE = int(os.getenv("EVENT_STREAM_QUEUE_SIZE", "256"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# Ограничение частоты запросов к /auth/login и /auth/register (token bucket в памяти процесса)
+# Формат лимита: "<запросов>/<секунд>", отдельно по IP и по email
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# За прокси (PythonAnywhere) адрес клиента берется из последнего адреса X-Forwarded-For, который добавил прокси
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "true" if IS_PYTHONANYWHERE else "false").lower() == "true"
+
+def parse_rate_limit(value: str) -> tuple[int, float]:
+    count, seconds = value.split("/", 1)
+    return int(count), float(seconds)
+
+RATE_LIMITS = {
+    "login": {
+        "ip": parse_rate_limit(os.getenv("RATE_LIMIT_LOGIN_IP", "30/60")),
+        "email": parse_rate_limit(os.getenv("RATE_LIMIT_LOGIN_EMAIL", "10/60")),
+    },
+    "register": {
+        "ip": parse_rate_limit(os.getenv("RATE_LIMIT_REGISTER_IP", "20/3600")),
+        "email": parse_rate_limit(os.getenv("RATE_LIMIT_REGISTER_EMAIL", "5/3600")),
+    },
+}
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
@@ -86,6 +197,7 @@ class User(Base):
     
     # Профиль пользователя
     gwars_profile_url = Column(String)  # Ссылка на профиль в gwars.io
+    gwars_profile_key = Column(Integer, unique=True, index=True, nullable=True)  # Канонический ключ профиля (id= из ссылки)
     gwars_nickname = Column(String)  # Никнейм из GWars профиля
     gwars_user_id = Column(Integer, unique=True, index=True, nullable=True)  # ID пользователя из GWars
     gwars_verification_token = Column(String)  # Токен для верификации GWars
@@ -123,6 +235,36 @@ class Event(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     created_by = Column(Integer, index=True)  # ID администратора, создавшего мероприятие
+    registration_version = Column(Integer, default=0, nullable=False)  # Растет при любом изменении списка участников
+    deleted_at = Column(DateTime, nullable=True, index=True)  # Удалено, строки мероприятия ждут фоновой очистки
+    
+    # Счетчики участников (таблица event_stats ведется в тех же транзакциях, что и регистрации)
+    stats = relationship(
+        "EventStats",
+        primaryjoin="Event.id == foreign(EventStats.event_id)",
+        uselist=False,
+        viewonly=True,
+        lazy="joined"
+    )
+    
+    @property
+    def preregistered_count(self) -> int:
+        return self.stats.preregistered_count if self.stats else 0
+    
+    @property
+    def confirmed_count(self) -> int:
+        return self.stats.confirmed_count if self.stats else 0
+    
+    @property
+    def participants_count(self) -> int:
+        return self.preregistered_count + self.confirmed_count
+
+class EventStats(Base):
+    __tablename__ = "event_stats"
+    
+    event_id = Column(Integer, primary_key=True)  # ID мероприятия
+    preregistered_count = Column(Integer, default=0, nullable=False)  # Ожидают подтверждения
+    confirmed_count = Column(Integer, default=0, nullable=False)  # Подтвердили участие
 
 class EventRegistration(Base):
     __tablename__ = "event_registrations"
@@ -135,6 +277,12 @@ class EventRegistration(Base):
     confirmed_address = Column(String)  # Подтвержденный адрес для подарка
     confirmed_at = Column(DateTime)  # Дата подтверждения
     created_at = Column(DateTime, default=datetime.utcnow)
+    idempotency_key = Column(String, nullable=True)  # Idempotency-Key запроса, создавшего регистрацию
+    
+    __table_args__ = (
+        # Одна регистрация пользователя на мероприятие
+        Index("ux_event_registrations_user_event", "user_id", "event_id", unique=True),
+    )
 
 class SystemSettings(Base):
     __tablename__ = "system_settings"
@@ -242,6 +390,840 @@ class GiftAssignment(Base):
     approved_by = Column(Integer, ForeignKey("users.id"))  # Кто утвердил
 
 
+class UserAssignmentVersion(Base):
+    __tablename__ = "user_assignment_versions"
+
+    user_id = Column(Integer, primary_key=True)  # ID пользователя
+    version = Column(Integer, default=0, nullable=False)  # Растет при изменении его назначений или данных второй стороны
+
+
+class DataVersion(Base):
+    __tablename__ = "data_versions"
+
+    name = Column(String, primary_key=True)  # Имя набора данных (например, public_users)
+    version = Column(Integer, default=0, nullable=False)  # Растет при каждом изменении набора
+
+
+class SchedulerLease(Base):
+    __tablename__ = "scheduler_leases"
+
+    name = Column(String, primary_key=True)  # Имя фоновой задачи
+    owner = Column(String, nullable=False)  # Процесс, который сейчас ведущий
+    expires_at = Column(DateTime, nullable=False)  # Аренда без продления истекает, и ведущим может стать другой
+
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    token_hash = Column(String, nullable=False, unique=True, index=True)  # sha256 от токена, сам токен не храним
+    expires_at = Column(DateTime, nullable=False)
+    revoked = Column(Boolean, default=False)  # Отозван (ротация, выход, блокировка)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш ограниченного размера, у каждой записи свой срок жизни"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_seconds: float):
+        if self.max_size <= 0 or ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry is not None else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Кэш принципалов для get_current_user
+class PrincipalCache:
+    """Ограниченный LRU-кэш снимков пользователей с TTL, ключ — id пользователя.
+
+    Хранит только значения колонок, а не ORM-объекты: при попадании снимок
+    присоединяется к сессии запроса без SQL-запроса (см. attach_cached_user).
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Счетчик инвалидаций: снимок, прочитанный до инвалидации, в кэш не попадет
+        self.generation = 0
+
+    def get(self, user_id: int) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, snapshot = entry
+            if expires_at <= time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def put(self, user: User, generation: int):
+        if self.max_size <= 0 or self.ttl_seconds <= 0:
+            return
+        snapshot = {attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs}
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[user.id] = (time.monotonic() + self.ttl_seconds, snapshot)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_MAX_SIZE, PRINCIPAL_CACHE_TTL_SECONDS)
+cross_server_replay_cache = TTLCache(CROSS_SERVER_REPLAY_CACHE_SIZE)
+
+
+def attach_cached_user(snapshot: dict, db: Session) -> User:
+    """Присоединяет снимок пользователя к сессии без обращения к БД"""
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+
+# Изменения пользователей инвалидируют кэш после коммита транзакции
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def queue_principal_invalidation(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault("principal_invalidations", set()).add(target.id)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def apply_principal_invalidations(session):
+    for user_id in session.info.pop("principal_invalidations", ()):
+        principal_cache.invalidate(user_id)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def discard_principal_invalidations(session):
+    session.info.pop("principal_invalidations", None)
+
+
+def bump_data_version(connection, name: str):
+    """Сдвигает версию набора данных одним UPSERT в текущей транзакции"""
+    connection.execute(
+        sqlite_insert(DataVersion).values(name=name, version=1).on_conflict_do_update(
+            index_elements=[DataVersion.name],
+            set_={"version": DataVersion.version + 1}
+        )
+    )
+
+
+class PublicUserDirectory:
+    """Готовый JSON публичного списка пользователей; пересобирается только после изменения версии
+
+    Версия хранится в БД (data_versions), поэтому снимок устаревает во всех воркерах сразу.
+    """
+
+    FIELDS = ("id", "gwars_nickname", "gwars_profile_url", "gwars_verified", "avatar_seed", "created_at")
+    VERSION_NAME = "public_users"
+
+    def __init__(self):
+        self._built_version = None
+        self._body = b""
+        self._etag = ""
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Сдвигает версию после изменений в обход событий ORM (массовые запросы)"""
+        with engine.begin() as connection:
+            bump_data_version(connection, self.VERSION_NAME)
+
+    def get(self, db: Session) -> tuple[bytes, str]:
+        version = db.query(DataVersion.version).filter(DataVersion.name == self.VERSION_NAME).scalar() or 0
+        with self._lock:
+            if self._built_version == version:
+                return self._body, self._etag
+        columns = [getattr(User, field) for field in self.FIELDS]
+        rows = [dict(row._mapping) for row in db.query(*columns).order_by(User.id)]
+        body = json.dumps(jsonable_encoder(rows), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        with self._lock:
+            self._body, self._etag, self._built_version = body, etag, version
+        return body, etag
+
+public_user_directory = PublicUserDirectory()
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_delete")
+def queue_public_directory_refresh(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info["public_directory_changed"] = True
+
+
+@event.listens_for(User, "after_update")
+def queue_public_directory_refresh_on_update(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in PublicUserDirectory.FIELDS):
+        queue_public_directory_refresh(mapper, connection, target)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def apply_public_directory_refresh(session, flush_context):
+    # Версия сдвигается в той же транзакции, что и изменения пользователей
+    if session.info.pop("public_directory_changed", False):
+        bump_data_version(session.connection(), PublicUserDirectory.VERSION_NAME)
+
+
+# Удаленные мероприятия скрыты из всех ORM-запросов до окончания очистки;
+# execution_options(include_deleted_events=True) отключает фильтр
+@event.listens_for(SessionLocal, "do_orm_execute")
+def hide_deleted_events(execute_state):
+    if (
+        execute_state.is_select
+        and not execute_state.is_column_load
+        and not execute_state.is_relationship_load
+        and not execute_state.execution_options.get("include_deleted_events", False)
+    ):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(Event, Event.deleted_at.is_(None), include_aliases=True)
+        )
+
+
+# Версия списка участников и счетчики event_stats меняются в той же транзакции, что и регистрация
+@event.listens_for(EventRegistration, "after_insert")
+@event.listens_for(EventRegistration, "after_update")
+@event.listens_for(EventRegistration, "after_delete")
+def bump_event_registration_version(mapper, connection, target):
+    connection.execute(
+        update(Event)
+        .where(Event.id == target.event_id)
+        .values(registration_version=Event.registration_version + 1)
+    )
+
+
+def apply_event_stats_delta(connection, event_id: int, preregistered_delta: int, confirmed_delta: int):
+    """Сдвигает счетчики мероприятия одним UPSERT"""
+    if not preregistered_delta and not confirmed_delta:
+        return
+    statement = sqlite_insert(EventStats).values(
+        event_id=event_id,
+        preregistered_count=max(preregistered_delta, 0),
+        confirmed_count=max(confirmed_delta, 0)
+    )
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[EventStats.event_id],
+        set_={
+            "preregistered_count": EventStats.preregistered_count + preregistered_delta,
+            "confirmed_count": EventStats.confirmed_count + confirmed_delta,
+        }
+    ))
+
+
+@event.listens_for(EventRegistration, "after_insert")
+def count_event_registration(mapper, connection, target):
+    if target.is_confirmed:
+        apply_event_stats_delta(connection, target.event_id, 0, 1)
+    else:
+        apply_event_stats_delta(connection, target.event_id, 1, 0)
+
+
+@event.listens_for(EventRegistration, "after_delete")
+def uncount_event_registration(mapper, connection, target):
+    if target.is_confirmed:
+        apply_event_stats_delta(connection, target.event_id, 0, -1)
+    else:
+        apply_event_stats_delta(connection, target.event_id, -1, 0)
+
+
+@event.listens_for(EventRegistration, "after_update")
+def recount_event_registration(mapper, connection, target):
+    history = inspect(target).attrs.is_confirmed.history
+    if not history.has_changes():
+        return
+    was_confirmed = bool(history.deleted[0]) if history.deleted else False
+    if was_confirmed != bool(target.is_confirmed):
+        step = 1 if target.is_confirmed else -1
+        apply_event_stats_delta(connection, target.event_id, -step, step)
+
+
+def assignment_user_ids(*criteria):
+    """Подзапрос: дарители и получатели назначений, подходящих под условия"""
+    return union(
+        select(GiftAssignment.giver_id).where(*criteria),
+        select(GiftAssignment.receiver_id).where(*criteria)
+    )
+
+
+def bump_assignment_versions(connection, user_ids):
+    """Сдвигает версии назначений пользователей (список id или подзапрос) одним UPSERT"""
+    users = select(User.id, literal(1)).where(User.id.in_(user_ids))
+    connection.execute(
+        sqlite_insert(UserAssignmentVersion).from_select(["user_id", "version"], users).on_conflict_do_update(
+            index_elements=[UserAssignmentVersion.user_id],
+            set_={"version": UserAssignmentVersion.version + 1}
+        )
+    )
+
+
+# Версии назначений дарителя и получателя (в том числе прежних при переназначении)
+@event.listens_for(GiftAssignment, "after_insert")
+@event.listens_for(GiftAssignment, "after_update")
+@event.listens_for(GiftAssignment, "after_delete")
+def bump_gift_assignment_versions(mapper, connection, target):
+    state = inspect(target)
+    user_ids = {target.giver_id, target.receiver_id}
+    for field in ("giver_id", "receiver_id"):
+        user_ids.update(state.attrs[field].history.deleted)
+    bump_assignment_versions(connection, [user_id for user_id in user_ids if user_id is not None])
+
+
+# Имена, email и адрес пользователя видны второй стороне его назначений
+ASSIGNMENT_USER_FIELDS = ("name", "full_name", "email", "address")
+
+@event.listens_for(User, "after_update")
+def bump_assignment_versions_on_profile_change(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in ASSIGNMENT_USER_FIELDS):
+        bump_assignment_versions(connection, assignment_user_ids(
+            or_(GiftAssignment.giver_id == target.id, GiftAssignment.receiver_id == target.id)
+        ))
+
+
+def delete_user_registrations(db: Session, user_ids) -> int:
+    """Удаляет регистрации пользователей одним DELETE, поправив версии и счетчики затронутых мероприятий"""
+    affected_events = select(EventRegistration.event_id).where(EventRegistration.user_id.in_(user_ids))
+    db.query(Event).filter(Event.id.in_(affected_events)).update(
+        {Event.registration_version: Event.registration_version + 1}, synchronize_session=False
+    )
+
+    def removed(is_confirmed: bool):
+        return select(func.count()).where(
+            EventRegistration.event_id == EventStats.event_id,
+            EventRegistration.user_id.in_(user_ids),
+            EventRegistration.is_confirmed == is_confirmed
+        ).scalar_subquery()
+
+    db.query(EventStats).filter(EventStats.event_id.in_(affected_events)).update({
+        EventStats.preregistered_count: EventStats.preregistered_count - removed(False),
+        EventStats.confirmed_count: EventStats.confirmed_count - removed(True),
+    }, synchronize_session=False)
+    return db.query(EventRegistration).filter(
+        EventRegistration.user_id.in_(user_ids)
+    ).delete(synchronize_session=False)
+
+
+def rebuild_event_stats(db: Session) -> int:
+    """Пересчитывает event_stats по таблице регистраций (коммит — на вызывающем коде)"""
+    db.query(EventStats).delete(synchronize_session=False)
+    confirmed = func.coalesce(func.sum(case((EventRegistration.is_confirmed == True, 1), else_=0)), 0)
+    rows = select(
+        EventRegistration.event_id,
+        func.count() - confirmed,
+        confirmed
+    ).where(EventRegistration.event_id.in_(select(Event.id).where(Event.deleted_at.is_(None)))).group_by(EventRegistration.event_id)
+    return db.execute(
+        EventStats.__table__.insert().from_select(["event_id", "preregistered_count", "confirmed_count"], rows)
+    ).rowcount
+
+
+def canonical_gwars_profile_key(profile_url: str | None) -> int | None:
+    """Возвращает числовой id персонажа из ссылки на профиль GWars (None — если это не ссылка на профиль)"""
+    if not profile_url:
+        return None
+    parsed = urlparse(profile_url.strip())
+    host = (parsed.hostname or "").lower()
+    if parsed.scheme.lower() not in ("http", "https") or host not in ("gwars.io", "www.gwars.io"):
+        return None
+    if parsed.path.lower() != "/info.php":
+        return None
+    ids = parse_qs(parsed.query).get("id")
+    if not ids or not ids[0].isdigit():
+        return None
+    return int(ids[0])
+
+@event.listens_for(User.gwars_profile_url, "set")
+def sync_gwars_profile_key(target, value, oldvalue, initiator):
+    # Ключ всегда следует за ссылкой, в каком бы виде её ни ввели
+    target.gwars_profile_key = canonical_gwars_profile_key(value)
+
+def find_gwars_profile_owner(db: Session, profile_url: str | None, exclude_user_id: int):
+    """Ищет другого пользователя с тем же персонажем GWars (один проход по уникальному индексу)"""
+    profile_key = canonical_gwars_profile_key(profile_url)
+    if profile_key is None:
+        return None
+    return db.query(User.id, User.email).filter(
+        User.gwars_profile_key == profile_key,
+        User.id != exclude_user_id
+    ).first()
+
+class RateLimiter:
+    """Token bucket: ключ -> (токены, время обновления, момент полного восстановления)"""
+
+    # Сколько давних ключей проверять при каждом обращении
+    EXPIRE_BATCH = 8
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, buckets) -> float:
+        """Списывает по токену из каждого ведра [(ключ, емкость, период)], только если токены есть во всех.
+
+        Возвращает 0 или число секунд до появления токена; отклоненный запрос токенов не тратит.
+        """
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            retry_after = 0.0
+            for key, capacity, period_seconds in buckets:
+                rate = capacity / period_seconds
+                state = self._buckets.pop(key, None)
+                tokens = capacity if state is None else min(capacity, state[0] + (now - state[1]) * rate)
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+                states.append((key, capacity, rate, tokens))
+            for key, capacity, rate, tokens in states:
+                if retry_after == 0:
+                    tokens -= 1
+                # Ключ уходит в конец: в начале словаря всегда самые давние обращения
+                self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            self._expire(now)
+            return retry_after
+
+    def _expire(self, now: float):
+        # Ленивая очистка: полностью восстановленное ведро ничем не отличается от отсутствующего
+        for _ in range(self.EXPIRE_BATCH):
+            if not self._buckets:
+                break
+            key, state = next(iter(self._buckets.items()))
+            if state[2] > now and len(self._buckets) <= self.max_keys:
+                break
+            del self._buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+rate_limiter = RateLimiter(RATE_LIMIT_MAX_KEYS)
+
+def get_client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            # Левые адреса присылает сам клиент, доверяем только последнему — его дописал прокси
+            return forwarded.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+def enforce_rate_limit(group: str, request: Request, email: str | None = None):
+    """Отклоняет запрос с 429, если исчерпан лимит группы по IP или по email"""
+    if not RATE_LIMIT_ENABLED:
+        return
+    limits = RATE_LIMITS[group]
+    keys = [("ip", get_client_ip(request))]
+    if email:
+        keys.append(("email", email.strip().lower()))
+    retry_after = rate_limiter.hit([((group, kind, value), *limits[kind]) for kind, value in keys])
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Слишком много попыток, попробуйте позже",
+            headers={"Retry-After": str(int(retry_after) + 1)}
+        )
+
+class CurrentEventCache:
+    """Готовый ответ /events/current со сроком до ближайшей границы фаз (начало предрегистрации, регистрации, конец)"""
+
+    def __init__(self, max_seconds: int):
+        self.max_seconds = max_seconds
+        self.generation = 0
+        self._cache = TTLCache(1)
+        self._lock = threading.Lock()
+
+    def get(self):
+        return self._cache.get("current")
+
+    def put(self, body: bytes, boundary: datetime | None, generation: int) -> tuple[bytes, datetime]:
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.max_seconds)
+        if boundary is not None and boundary < expires_at:
+            expires_at = boundary
+        with self._lock:
+            # Мероприятия изменились, пока ответ собирался, — такой ответ не кэшируем
+            if generation == self.generation:
+                self._cache.set("current", (body, expires_at), (expires_at - now).total_seconds())
+        return body, expires_at
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._cache.clear()
+
+current_event_cache = CurrentEventCache(CURRENT_EVENT_CACHE_MAX_SECONDS)
+
+
+def sse_message(kind: str, data) -> str:
+    payload = json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":"))
+    return f"event: {kind}\ndata: {payload}\n\n"
+
+
+class EventStreamBus:
+    """Внутрипроцессная шина изменений мероприятий для SSE-подписчиков
+    
+    Обработчики регистраций публикуют небольшие дельты, каждый подписчик получает их через свою очередь.
+    Очередь доставляется в цикле событий своего подписчика (под WSGI-адаптером у каждого запроса свой цикл),
+    publish и close можно вызывать из любого потока, и они никогда не бросают исключений.
+    """
+
+    def __init__(self, max_connections: int, queue_size: int):
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self._subscribers = {}  # event_id -> {очередь подписчика: ее цикл событий}
+        self._connections = 0
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def subscribe(self, event_id: int) -> asyncio.Queue | None:
+        """Очередь нового подписчика; None — достигнут лимит подключений"""
+        with self._lock:
+            if self._connections >= self.max_connections:
+                self.rejected += 1
+                return None
+            queue = asyncio.Queue(self.queue_size)
+            self._subscribers.setdefault(event_id, {})[queue] = asyncio.get_running_loop()
+            self._connections += 1
+            return queue
+
+    def unsubscribe(self, event_id: int, queue: asyncio.Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(event_id)
+            if subscribers is None or subscribers.pop(queue, None) is None:
+                return
+            self._connections -= 1
+            if not subscribers:
+                del self._subscribers[event_id]
+
+    def publish(self, event_id: int, kind: str, data):
+        if event_id not in self._subscribers:
+            return
+        try:
+            self._dispatch(event_id, sse_message(kind, data))
+        except Exception as e:
+            # Поток — дополнение к ответу: запись уже сохранена, ошибка доставки не должна ее отменять
+            print(f"Ошибка публикации в поток мероприятия {event_id}: {e}")
+
+    def close(self, event_id: int):
+        """Завершает все потоки мероприятия"""
+        if event_id not in self._subscribers:
+            return
+        try:
+            self._dispatch(event_id, None)
+        except Exception as e:
+            print(f"Ошибка закрытия потоков мероприятия {event_id}: {e}")
+
+    def _dispatch(self, event_id: int, message: str | None):
+        with self._lock:
+            by_loop = {}
+            for queue, loop in self._subscribers.get(event_id, {}).items():
+                by_loop.setdefault(loop, []).append(queue)
+        self.published += 1
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        for loop, queues in by_loop.items():
+            if loop is running_loop:
+                self._deliver(event_id, queues, message)
+                continue
+            try:
+                loop.call_soon_threadsafe(self._deliver, event_id, queues, message)
+            except RuntimeError:
+                # Цикл подписчика уже закрыт (запрос под WSGI завершился) — подписчик больше не слушает
+                for queue in queues:
+                    self.unsubscribe(event_id, queue)
+
+    def _deliver(self, event_id: int, queues: list, message: str | None):
+        for queue in queues:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Медленный клиент: отключаем, после переподключения он получит свежий снимок
+                self.dropped += 1
+                self.unsubscribe(event_id, queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def metrics(self) -> dict:
+        return {
+            "enabled": EVENT_STREAM_ENABLED,
+            "connections": self._connections,
+            "max_connections": self.max_connections,
+            "events": len(self._subscribers),
+            "published": self.published,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+        }
+
+
+event_stream_bus = EventStreamBus(EVENT_STREAM_MAX_CONNECTIONS, EVENT_STREAM_QUEUE_SIZE)
+
+
+# Метрики времени выполнения
+class TimingStats:
+    """Счетчик длительностей: количество, среднее, максимум и p95 по последним замерам"""
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self._recent.append(seconds)
+
+    def snapshot(self) -> dict:
+        recent = sorted(self._recent)
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+            "p95_ms": round(p95 * 1000, 3),
+        }
+
+
+class PasswordHasher:
+    """Выделенный пул потоков для bcrypt с ограниченной очередью.
+
+    Если в работе и в очереди уже workers + queue_depth операций, новые запросы
+    сразу получают 503, вместо того чтобы копить задержку.
+    """
+
+    def __init__(self, workers: int, queue_depth: int):
+        self.workers = max(1, workers)
+        self.queue_depth = max(0, queue_depth)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+        self.queue_wait = TimingStats()
+        self.hash_time = TimingStats()
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self.in_flight >= self.workers + self.queue_depth:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Сервер перегружен, попробуйте позже",
+                    headers={"Retry-After": "1"},
+                )
+            self.in_flight += 1
+        submitted_at = time.perf_counter()
+
+        def job():
+            started_at = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                finished_at = time.perf_counter()
+                with self._lock:
+                    self.in_flight -= 1
+                    self.queue_wait.add(started_at - submitted_at)
+                    self.hash_time.add(finished_at - started_at)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self.queue_depth,
+                "bcrypt_rounds": BCRYPT_ROUNDS,
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+                "queue_wait": self.queue_wait.snapshot(),
+                "hash_time": self.hash_time.snapshot(),
+            }
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_DEPTH)
+
+
+class BatchWriter:
+    """Одна задача-писатель: операции из очереди выполняются пакетами в одной транзакции.
+
+    Операция — функция func(connection, *args); результат возвращается вызывающему через future.
+    Пакет фиксируется, когда набралось batch_size операций или прошло flush_interval_ms.
+    Если пакет упал, операции повторяются по одной, чтобы ошибка досталась только своему запросу.
+    """
+
+    def __init__(self, enabled: bool, batch_size: int, flush_interval_ms: float, queue_depth: int):
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval_ms) / 1000
+        self.queue_depth = max(1, queue_depth)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-writer")
+        self._queue = None
+        self._loop = None
+        self._task = None
+        self.batches = 0
+        self.operations = 0
+        self.max_batch = 0
+        self.last_batch = 0
+        self.rejected = 0
+        self.failed_batches = 0
+        self.commit_time = TimingStats()
+
+    async def submit(self, func, *args):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            # Писатель привязан к event loop процесса; создаем его при первой записи
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.queue_depth)
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait((func, args, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Сервер перегружен, попробуйте позже",
+                headers={"Retry-After": "1"},
+            )
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            outcomes = await loop.run_in_executor(self._executor, self._write, [(func, args) for func, args, _ in batch])
+            for (_, _, future), (ok, value) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _write(self, operations: list) -> list:
+        started_at = time.perf_counter()
+        try:
+            with engine.begin() as connection:
+                outcomes = [(True, func(connection, *args)) for func, args in operations]
+        except Exception:
+            self.failed_batches += 1
+            outcomes = []
+            for func, args in operations:
+                try:
+                    with engine.begin() as connection:
+                        outcomes.append((True, func(connection, *args)))
+                except Exception as e:
+                    outcomes.append((False, e))
+        self.commit_time.add(time.perf_counter() - started_at)
+        self.batches += 1
+        self.operations += len(operations)
+        self.last_batch = len(operations)
+        self.max_batch = max(self.max_batch, len(operations))
+        return outcomes
+
+    def metrics(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": self.flush_interval * 1000,
+            "queue_depth": self.queue_depth,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "batches": self.batches,
+            "operations": self.operations,
+            "avg_batch": round(self.operations / self.batches, 2) if self.batches else 0.0,
+            "last_batch": self.last_batch,
+            "max_batch": self.max_batch,
+            "failed_batches": self.failed_batches,
+            "rejected": self.rejected,
+            "commit_time": self.commit_time.snapshot(),
+        }
+
+
+registration_writer = BatchWriter(
+    REGISTRATION_SURGE_MODE,
+    REGISTRATION_BATCH_SIZE,
+    REGISTRATION_FLUSH_INTERVAL_MS,
+    REGISTRATION_QUEUE_DEPTH
+)
+
+
+# Маркер «пароль не задан» для пользователей, входящих только через GWars
+UNUSABLE_PASSWORD = "!"
+
+def has_usable_password(hashed_password: str | None) -> bool:
+    return bool(hashed_password) and not hashed_password.startswith(UNUSABLE_PASSWORD)
+
 # Password and JWT functions
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -249,6 +1231,13 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def verify_password_async(plain_password, hashed_password) -> tuple[bool, str | None]:
+    """Проверяет пароль в пуле bcrypt; вторым элементом возвращает новый хэш, если изменилась стоимость"""
+    return await password_hasher.run(pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def get_password_hash_async(password) -> str:
+    return await password_hasher.run(pwd_context.hash, password)
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
@@ -259,12 +1248,57 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def authenticate_user(email: str, password: str, db: Session):
+def hash_refresh_token(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+def create_refresh_token(user_id: int, db: Session) -> str:
+    """Создает refresh-токен пользователя; коммит выполняет вызывающий код"""
+    refresh_token = token_urlsafe(32)
+    db.add(RefreshToken(
+        user_id=user_id,
+        token_hash=hash_refresh_token(refresh_token),
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    ))
+    return refresh_token
+
+def issue_session_tokens(user: User, db: Session) -> dict:
+    """Выдает пару access/refresh токенов при входе и фиксирует refresh-токен в БД"""
+    # При входе попутно чистим истекшие и отозванные токены этого пользователя (индекс по user_id)
+    db.query(RefreshToken).filter(
+        RefreshToken.user_id == user.id,
+        (RefreshToken.expires_at < datetime.utcnow()) | (RefreshToken.revoked == True)
+    ).delete(synchronize_session=False)
+    access_token = create_access_token(
+        data={"sub": user.email, "uid": user.id},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh_token = create_refresh_token(user.id, db)
+    db.commit()
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
+def revoke_user_refresh_tokens(user_id: int, db: Session) -> int:
+    """Отзывает все активные refresh-токены пользователя; коммит выполняет вызывающий код"""
+    return db.query(RefreshToken).filter(
+        RefreshToken.user_id == user_id,
+        RefreshToken.revoked == False
+    ).update({RefreshToken.revoked: True}, synchronize_session=False)
+
+async def authenticate_user(email: str, password: str, db: Session):
     user = db.query(User).filter(User.email == email).first()
-    if not user:
+    if not user or not has_usable_password(user.hashed_password):
         return False
-    if not verify_password(password, user.hashed_password):
+    is_valid, new_hash = await verify_password_async(password, user.hashed_password)
+    if not is_valid:
         return False
+    if new_hash:
+        # Стоимость bcrypt изменилась — сохраняем пересчитанный хэш
+        user.hashed_password = new_hash
+        db.commit()
     return user
 
 # Create tables
@@ -308,6 +1342,37 @@ try:
 except Exception as e:
     print(f"Миграция users.* пропущена или не удалась: {e}")
 
+# Канонический ключ профиля GWars: колонка, заполнение по существующим ссылкам и уникальный индекс
+try:
+    with engine.begin() as conn:
+        cols = conn.execute(text("PRAGMA table_info(users)")).fetchall()
+        if 'gwars_profile_key' not in {row[1] for row in cols}:
+            conn.execute(text("ALTER TABLE users ADD COLUMN gwars_profile_key INTEGER"))
+            rows = conn.execute(text(
+                "SELECT id, gwars_profile_url FROM users WHERE gwars_profile_url IS NOT NULL "
+                "ORDER BY gwars_verified DESC, id"
+            )).fetchall()
+            seen_keys = set()
+            for user_id, profile_url in rows:
+                profile_key = canonical_gwars_profile_key(profile_url)
+                if profile_key is None:
+                    continue
+                if profile_key in seen_keys:
+                    # Дубликат персонажа — ключ остаётся за верифицированным (или более ранним) пользователем
+                    print(f"Пользователь {user_id}: персонаж {profile_key} уже привязан к другому аккаунту")
+                    continue
+                seen_keys.add(profile_key)
+                conn.execute(
+                    text("UPDATE users SET gwars_profile_key = :key WHERE id = :id"),
+                    {"key": profile_key, "id": user_id}
+                )
+            print(f"Добавлен столбец users.gwars_profile_key (заполнено: {len(seen_keys)})")
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_gwars_profile_key ON users(gwars_profile_key)"
+        ))
+except Exception as e:
+    print(f"Миграция users.gwars_profile_key пропущена или не удалась: {e}")
+
 # Лёгкая миграция для добавления столбца event_start, если его нет
 try:
     with engine.begin() as conn:
@@ -316,9 +1381,116 @@ try:
         if 'event_start' not in columns:
             conn.execute(text("ALTER TABLE events ADD COLUMN event_start DATETIME"))
             print("Добавлен столбец events.event_start")
+        if 'registration_version' not in columns:
+            conn.execute(text("ALTER TABLE events ADD COLUMN registration_version INTEGER NOT NULL DEFAULT 0"))
+            print("Добавлен столбец events.registration_version")
+        if 'deleted_at' not in columns:
+            conn.execute(text("ALTER TABLE events ADD COLUMN deleted_at DATETIME"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_events_deleted_at ON events(deleted_at)"))
+            print("Добавлен столбец events.deleted_at")
 except Exception as mig_err:
     print(f"Миграция event_start пропущена или не удалась: {mig_err}")
 
+# Уникальность регистрации (user_id, event_id): убираем старые дубликаты и создаем индекс
+try:
+    with engine.begin() as conn:
+        cols = conn.execute(text("PRAGMA table_info(event_registrations)")).fetchall()
+        if 'idempotency_key' not in {row[1] for row in cols}:
+            conn.execute(text("ALTER TABLE event_registrations ADD COLUMN idempotency_key TEXT"))
+            print("Добавлен столбец event_registrations.idempotency_key")
+        index_exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type='index' AND name='ux_event_registrations_user_event'"
+        )).fetchone()
+        if not index_exists:
+            # Из дубликатов остается подтвержденная (или самая ранняя) регистрация; NULL в старых строках — не подтверждена
+            removed = conn.execute(text(
+                """
+                DELETE FROM event_registrations WHERE id IN (
+                    SELECT r.id FROM event_registrations r
+                    JOIN event_registrations k ON k.user_id = r.user_id AND k.event_id = r.event_id
+                    WHERE COALESCE(k.is_confirmed, 0) > COALESCE(r.is_confirmed, 0)
+                       OR (COALESCE(k.is_confirmed, 0) = COALESCE(r.is_confirmed, 0) AND k.id < r.id)
+                )
+                """
+            )).rowcount
+            conn.execute(text(
+                "CREATE UNIQUE INDEX ux_event_registrations_user_event ON event_registrations(user_id, event_id)"
+            ))
+            if removed:
+                conn.execute(text("DELETE FROM event_stats"))
+                print(f"Удалено дублирующихся регистраций: {removed}")
+            print("Создан уникальный индекс event_registrations(user_id, event_id)")
+except Exception as e:
+    print(f"Миграция event_registrations пропущена или не удалась: {e}")
+
+# Счетчики участников для баз, созданных до появления event_stats
+try:
+    with engine.begin() as conn:
+        has_stats = conn.execute(text("SELECT 1 FROM event_stats LIMIT 1")).fetchone()
+        has_registrations = conn.execute(text("SELECT 1 FROM event_registrations LIMIT 1")).fetchone()
+    if has_registrations and not has_stats:
+        db = SessionLocal()
+        try:
+            rebuilt = rebuild_event_stats(db)
+            db.commit()
+            print(f"Заполнена таблица event_stats (мероприятий: {rebuilt})")
+        finally:
+            db.close()
+except Exception as e:
+    print(f"Миграция event_stats пропущена или не удалась: {e}")
+
+# Полнотекстовый индекс пользователей для поиска в админке (SQLite FTS5).
+# Индекс внешнего содержимого над users, синхронизируется триггерами.
+# Триграммы дают поиск по подстроке; на старых SQLite без trigram — токены unicode61 с префиксами.
+USER_SEARCH_COLUMNS = ("email", "name", "gwars_nickname", "full_name")
+USER_SEARCH_MODE = None  # "trigram", "unicode61" или None (FTS5 недоступен — поиск через LIKE)
+users_fts_table = table("users_fts", column("rowid"), column("rank"))
+
+def ensure_user_search_index():
+    global USER_SEARCH_MODE
+    columns = ", ".join(USER_SEARCH_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in USER_SEARCH_COLUMNS)
+    old_values = ", ".join(f"old.{column}" for column in USER_SEARCH_COLUMNS)
+    with engine.begin() as conn:
+        existing = conn.execute(text("SELECT sql FROM sqlite_master WHERE type='table' AND name='users_fts'")).fetchone()
+        if existing:
+            USER_SEARCH_MODE = "trigram" if "trigram" in existing[0] else "unicode61"
+            return
+        for mode in ("trigram", "unicode61"):
+            try:
+                with conn.begin_nested():
+                    conn.execute(text(
+                        f"CREATE VIRTUAL TABLE users_fts USING fts5({columns}, "
+                        f"content='users', content_rowid='id', tokenize='{mode}')"
+                    ))
+                USER_SEARCH_MODE = mode
+                break
+            except Exception:
+                continue
+        if USER_SEARCH_MODE is None:
+            return
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+            f"INSERT INTO users_fts(rowid, {columns}) VALUES (new.id, {new_values}); END"
+        ))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+            f"INSERT INTO users_fts(users_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END"
+        ))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF {columns} ON users BEGIN "
+            f"INSERT INTO users_fts(users_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO users_fts(rowid, {columns}) VALUES (new.id, {new_values}); END"
+        ))
+        # Заполняем индекс существующими пользователями
+        conn.execute(text("INSERT INTO users_fts(users_fts) VALUES ('rebuild')"))
+        print(f"Создан полнотекстовый индекс users_fts ({USER_SEARCH_MODE})")
+
+try:
+    ensure_user_search_index()
+except Exception as fts_err:
+    print(f"Миграция users_fts пропущена или не удалась: {fts_err}")
+
 # Create default admin user
 def create_default_admin():
     db = SessionLocal()
@@ -546,9 +1718,27 @@ class UserResponse(BaseModel):
 class BlockUserRequest(BaseModel):
     reason: str  # Причина блокировки
 
+class BulkUserFilter(BaseModel):
+    role: str | None = None
+    is_active: bool | None = None
+    gwars_verified: bool | None = None
+    is_test: bool | None = None
+    profile_completed: bool | None = None
+
+class BulkUserOperation(BaseModel):
+    action: str  # block, unblock, promote, demote, delete
+    user_ids: list[int] | None = None  # Явный список пользователей
+    filter: BulkUserFilter | None = None  # Или условие отбора (можно вместе со списком)
+    reason: str | None = None  # Причина блокировки для action=block
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
+    expires_in: int | None = None  # Время жизни access-токена в секундах
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 # Модели для пошагового заполнения профиля
 class ProfileStep1(BaseModel):
@@ -610,6 +1800,14 @@ class EventResponse(BaseModel):
     is_active: bool
     created_at: datetime
     created_by: int
+    preregistered_count: int = 0
+    confirmed_count: int = 0
+    participants_count: int = 0
+
+class EventListItemResponse(EventResponse):
+    assignments_count: int = 0
+    approved_assignments_count: int = 0
+    assignment_status: str = "none"  # none, pending, approved
 
 class EventRegistrationCreate(BaseModel):
     registration_type: str = "preregistration"  # preregistration, registration
@@ -812,6 +2010,16 @@ class GiftAssignmentUpdate(BaseModel):
 class GiftAssignmentApproval(BaseModel):
     is_approved: bool
 
+class GiftAssignmentGenerateOptions(BaseModel):
+    # Пары пользователей, которые не должны дарить друг другу
+    exclude_pairs: list[tuple[int, int]] = []
+    # Не повторять пары стольких предыдущих мероприятий
+    history_events: int = GIFT_ASSIGNMENT_HISTORY_EVENTS
+    # Не назначать друг другу участников с одинаковым адресом
+    exclude_same_address: bool = GIFT_ASSIGNMENT_EXCLUDE_SAME_ADDRESS
+    # Произвольные группы (например, синдикат GWars): user_id -> название, внутри группы не дарят
+    groups: dict[int, str] = {}
+
 
 # FastAPI app
 app = FastAPI(title="Анонимный Дед Мороз", version="0.1.24")
@@ -889,12 +2097,16 @@ else:
 # Убираем пробелы и пустые строки
 allowed_origins = [origin.strip() for origin in allowed_origins if origin.strip()]
 
+# Заголовки ответа, которые фронтенд должен видеть при кросс-доменных запросах
+EXPOSED_RESPONSE_HEADERS = ["X-Next-Cursor", "ETag"]
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
-    allow_headers=["Authorization", "Content-Type", "Accept", "X-Requested-With"],
+    allow_headers=["Authorization", "Content-Type", "Accept", "X-Requested-With", "If-None-Match", "Idempotency-Key"],
+    expose_headers=EXPOSED_RESPONSE_HEADERS,
 )
 
 ALLOWED_ORIGINS = set(allowed_origins)
@@ -913,6 +2125,7 @@ async def ensure_cors_headers(request: Request, call_next):
         response.headers["Access-Control-Allow-Credentials"] = "true"
         response.headers["Access-Control-Allow-Headers"] = request.headers.get("access-control-request-headers", "*")
         response.headers["Access-Control-Allow-Methods"] = request.headers.get("access-control-request-method", "*")
+        response.headers["Access-Control-Expose-Headers"] = ", ".join(EXPOSED_RESPONSE_HEADERS)
     return response
 
 # Универсальный обработчик preflight-запросов
@@ -936,6 +2149,15 @@ def get_db():
     finally:
         db.close()
 
+def etag_matches(request: Request, etag: str) -> bool:
+    """Проверяет If-None-Match: клиент уже имеет актуальную версию ответа"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (candidate.strip().removeprefix("W/") for candidate in header.split(","))
+
 def mask_email(email: str) -> str:
     """Маскирует email: показывает только первую букву учетной записи, последнюю букву домена и полностью доменную зону.
     
@@ -980,39 +2202,47 @@ def mask_email(email: str) -> str:
         return email
 
 # JWT dependency
+def resolve_principal(token: str, db: Session) -> User | None:
+    """Находит пользователя по JWT, используя кэш принципалов по id"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    email: str = payload.get("sub")
+    if email is None:
+        return None
+    user_id = payload.get("uid")
+    if user_id is not None:
+        snapshot = principal_cache.get(user_id)
+        # Токен выдан на email: если email сменился, кэш не должен его принимать
+        if snapshot is not None and snapshot["email"] == email:
+            return attach_cached_user(snapshot, db)
+    generation = principal_cache.generation
+    user = db.query(User).filter(User.email == email).first()
+    if user is not None:
+        principal_cache.put(user, generation)
+    return user
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = db.query(User).filter(User.email == email).first()
+    user = resolve_principal(token, db)
     if user is None:
         raise credentials_exception
     return user
 
 def get_current_user_optional(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     """Получение текущего пользователя, но без ошибки если токен недействителен"""
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            return None
-    except JWTError:
-        return None
-    user = db.query(User).filter(User.email == email).first()
-    return user
+    return resolve_principal(token, db)
 
 def get_current_admin(current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Not enough permissions")
+    # Без startup-хуков (WSGI) прерванная очистка мероприятий продолжается при первом запросе администратора
+    resume_event_purges()
     return current_user
 
 # Alias for compatibility
@@ -1022,7 +2252,9 @@ get_current_admin_user = get_current_admin
 # Главная страница обрабатывается catch-all роутом, если фронтенд развернут
 
 @app.post("/auth/register", response_model=UserResponse)
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: UserCreate, request: Request, db: Session = Depends(get_db)):
+    enforce_rate_limit("register", request, user.email)
+    
     # Проверяем совпадение паролей
     if user.password != user.confirm_password:
         raise HTTPException(status_code=400, detail="Пароли не совпадают")
@@ -1037,7 +2269,7 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     
     db_user = User(
         email=user.email,
-        hashed_password=get_password_hash(user.password),
+        hashed_password=await get_password_hash_async(user.password),
         name=name_from_email,  # Use email prefix as name
         wishlist="",
         role="user",
@@ -1057,19 +2289,80 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     return db_user
 
 @app.post("/auth/login", response_model=Token)
-async def login_user(user: UserLogin, db: Session = Depends(get_db)):
-    user_data = authenticate_user(user.email, user.password, db)
+async def login_user(user: UserLogin, request: Request, db: Session = Depends(get_db)):
+    enforce_rate_limit("login", request, user.email)
+    user_data = await authenticate_user(user.email, user.password, db)
     if not user_data:
         raise HTTPException(
             status_code=401,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return issue_session_tokens(user_data, db)
+
+@app.post("/auth/refresh", response_model=Token)
+async def refresh_session(request_data: RefreshTokenRequest, db: Session = Depends(get_db)):
+    """Ротация refresh-токена: выдает новую пару токенов без проверки пароля"""
+    credentials_exception = HTTPException(
+        status_code=401,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    row = db.query(RefreshToken, User.email).join(User, User.id == RefreshToken.user_id).filter(
+        RefreshToken.token_hash == hash_refresh_token(request_data.refresh_token)
+    ).first()
+    if not row:
+        raise credentials_exception
+    stored_token, email = row
+    if stored_token.revoked:
+        # Повторное использование уже отозванного токена — вероятна утечка, закрываем все сессии
+        revoke_user_refresh_tokens(stored_token.user_id, db)
+        db.commit()
+        raise credentials_exception
+    if stored_token.expires_at <= datetime.utcnow():
+        raise credentials_exception
+    
+    # Отзыв условным UPDATE: из параллельных запросов с одним токеном ротацию выполнит только один
+    revoked_count = db.query(RefreshToken).filter(
+        RefreshToken.id == stored_token.id,
+        or_(RefreshToken.revoked == False, RefreshToken.revoked.is_(None))
+    ).update({RefreshToken.revoked: True}, synchronize_session=False)
+    if revoked_count != 1:
+        db.rollback()
+        revoke_user_refresh_tokens(stored_token.user_id, db)
+        db.commit()
+        raise credentials_exception
     access_token = create_access_token(
-        data={"sub": user_data.email}, expires_delta=access_token_expires
+        data={"sub": email, "uid": stored_token.user_id},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    refresh_token = create_refresh_token(stored_token.user_id, db)
+    db.commit()
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
+@app.post("/auth/logout")
+async def logout_session(request_data: RefreshTokenRequest, db: Session = Depends(get_db)):
+    """Отзыв refresh-токена текущей сессии"""
+    db.query(RefreshToken).filter(
+        RefreshToken.token_hash == hash_refresh_token(request_data.refresh_token)
+    ).update({RefreshToken.revoked: True}, synchronize_session=False)
+    db.commit()
+    return {"message": "Сессия завершена"}
+
+@app.post("/auth/logout-all")
+async def logout_all_sessions(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Отзыв всех refresh-токенов текущего пользователя"""
+    revoked_count = revoke_user_refresh_tokens(current_user.id, db)
+    db.commit()
+    return {"message": "Все сессии завершены", "revoked": revoked_count}
 
 @app.get("/auth/me", response_model=UserResponse)
 async def get_current_user_info(current_user: User = Depends(get_current_user)):
@@ -1083,9 +2376,13 @@ async def get_profile_status(current_user: User = Depends(get_current_user)):
     # Обновляем статус в базе данных и синхронизируем токен
     db = SessionLocal()
     active_token = None
+    user_changed = False
     try:
         try:
-            db.execute(text("UPDATE users SET profile_completed = :pc WHERE id = :uid"), {"pc": is_completed, "uid": current_user.id})
+            # Пишем только при изменении, чтобы опрос статуса не сбрасывал кэш принципалов
+            if bool(current_user.profile_completed) != is_completed:
+                db.execute(text("UPDATE users SET profile_completed = :pc WHERE id = :uid"), {"pc": is_completed, "uid": current_user.id})
+                user_changed = True
         except Exception as e:
             db.rollback()
             print(f"[profile/status] update profile_completed failed: {e}")
@@ -1094,6 +2391,7 @@ async def get_profile_status(current_user: User = Depends(get_current_user)):
             active_token = row[0] if row else None
             if active_token and active_token != current_user.gwars_verification_token:
                 db.execute(text("UPDATE users SET gwars_verification_token = :tok WHERE id = :uid"), {"tok": active_token, "uid": current_user.id})
+                user_changed = True
         except Exception as e:
             db.rollback()
             print(f"[profile/status] fetch/sync verification token failed: {e}")
@@ -1104,23 +2402,29 @@ async def get_profile_status(current_user: User = Depends(get_current_user)):
                 db.rollback()
     finally:
         db.close()
+    if user_changed:
+        principal_cache.invalidate(current_user.id)
     
+    return profile_status_payload(current_user, active_token)
+
+def profile_status_payload(user: User, active_token: str | None = None) -> dict:
+    """Тело ответа /profile/status без побочных записей в БД"""
     return {
-        "profile_completed": is_completed,
+        "profile_completed": check_profile_completion(user),
         "steps": {
-            "gwars_verified": current_user.gwars_verified,
-            "personal_info": bool(current_user.full_name and current_user.address),
-            "interests": bool(current_user.interests)
+            "gwars_verified": user.gwars_verified,
+            "personal_info": bool(user.full_name and user.address),
+            "interests": bool(user.interests)
         },
         "missing_fields": {
-            "gwars_profile_url": current_user.gwars_profile_url is None,
-            "gwars_nickname": current_user.gwars_nickname is None,
-            "gwars_verified": not current_user.gwars_verified,
-            "full_name": current_user.full_name is None,
-            "address": current_user.address is None,
-            "interests": current_user.interests is None
+            "gwars_profile_url": user.gwars_profile_url is None,
+            "gwars_nickname": user.gwars_nickname is None,
+            "gwars_verified": not user.gwars_verified,
+            "full_name": user.full_name is None,
+            "address": user.address is None,
+            "interests": user.interests is None
         },
-        "gwars_verification_token": active_token or current_user.gwars_verification_token
+        "gwars_verification_token": active_token or user.gwars_verification_token
     }
 
 def validate_gwars_url(url: str) -> bool:
@@ -1279,10 +2583,7 @@ async def check_gwars_url_unique(
     
     # Проверяем уникальность ссылки на игровой профиль
     # Исключаем текущего пользователя из проверки
-    existing_user = db.query(User).filter(
-        User.gwars_profile_url == profile_url,
-        User.id != current_user.id
-    ).first()
+    existing_user = find_gwars_profile_owner(db, profile_url, current_user.id)
     
     if existing_user:
         masked_email = mask_email(existing_user.email)
@@ -1314,10 +2615,7 @@ async def parse_gwars_profile_endpoint(
     
     # Проверяем уникальность ссылки на игровой профиль
     # Исключаем текущего пользователя из проверки
-    existing_user = db.query(User).filter(
-        User.gwars_profile_url == profile_url,
-        User.id != current_user.id
-    ).first()
+    existing_user = find_gwars_profile_owner(db, profile_url, current_user.id)
     
     if existing_user:
         masked_email = mask_email(existing_user.email)
@@ -1378,10 +2676,7 @@ async def verify_gwars_profile(
         
         # Проверяем уникальность ссылки на игровой профиль
         # Исключаем текущего пользователя из проверки
-        existing_user = db.query(User).filter(
-            User.gwars_profile_url == profile_url,
-            User.id != current_user.id
-        ).first()
+        existing_user = find_gwars_profile_owner(db, profile_url, current_user.id)
         
         if existing_user:
             masked_email = mask_email(existing_user.email)
@@ -1563,111 +2858,274 @@ def verify_gwars_token_in_profile(profile_url: str, token: str) -> tuple[bool, s
         return False, f"Произошла ошибка при проверке токена: {str(e)}"
 
 # Функции для работы с назначениями подарков
-def generate_gift_assignments(event_id: int, db: Session):
-    """Генерирует случайные назначения подарков для мероприятия"""
-    # Получаем всех подтвержденных участников мероприятия
-    participants = db.query(EventRegistration).filter(
+def normalize_address(address: str | None) -> str | None:
+    """Адрес для сравнения «одно хозяйство»: без регистра, пунктуации и лишних пробелов"""
+    if not address:
+        return None
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", address.lower()).split())
+    return normalized or None
+
+def collect_assignment_exclusions(db: Session, event_id: int, participant_ids: list[int], options: GiftAssignmentGenerateOptions):
+    """Собирает ограничения для распределения: запрещенные пары и правила «одинаковый атрибут»"""
+    forbidden_pairs = list(options.exclude_pairs)
+    
+    if options.history_events > 0:
+        # Пары последних мероприятий до текущего, в которых были назначения
+        previous_events = select(Event.id).where(
+            Event.id < event_id,
+            Event.id.in_(select(GiftAssignment.event_id))
+        ).order_by(Event.id.desc()).limit(options.history_events)
+        forbidden_pairs.extend(
+            db.query(GiftAssignment.giver_id, GiftAssignment.receiver_id).filter(
+                GiftAssignment.event_id.in_(previous_events)
+            ).all()
+        )
+    
+    groups = []
+    if options.exclude_same_address:
+        addresses = db.query(User.id, User.address).filter(User.id.in_(participant_ids)).all()
+        groups.append({user_id: normalize_address(address) for user_id, address in addresses})
+    if options.groups:
+        groups.append(options.groups)
+    return forbidden_pairs, groups
+
+# Предпросмотры распределений: токен -> мероприятие, состав участников и пары
+assignment_previews = TTLCache(max_size=64)
+
+def participants_signature(participant_ids: list[int]) -> str:
+    return hashlib.sha256(",".join(map(str, sorted(participant_ids))).encode()).hexdigest()
+
+def generate_gift_assignments(
+    event_id: int,
+    db: Session,
+    options: GiftAssignmentGenerateOptions | None = None,
+    dry_run: bool = False,
+    preview_token: str | None = None
+) -> dict:
+    """Генерирует случайные назначения подарков для мероприятия с учетом ограничений
+    
+    dry_run — только рассчитать пары и сохранить их под токеном предпросмотра;
+    preview_token — сохранить ранее рассчитанный предпросмотр без пересчета.
+    """
+    options = options or GiftAssignmentGenerateOptions()
+    
+    # Получаем ID всех подтвержденных участников мероприятия
+    participant_ids = [user_id for (user_id,) in db.query(EventRegistration.user_id).filter(
         EventRegistration.event_id == event_id,
         EventRegistration.is_confirmed == True
-    ).all()
+    ).all()]
     
-    if len(participants) < 2:
+    if len(participant_ids) < 2:
         raise HTTPException(status_code=400, detail="Недостаточно участников для назначения подарков")
     
-    # Получаем ID участников
-    participant_ids = [reg.user_id for reg in participants]
-    
     # Проверяем, есть ли уже назначения для этого мероприятия
-    existing_assignments = db.query(GiftAssignment).filter(
+    existing_assignment = db.query(GiftAssignment.id).filter(
         GiftAssignment.event_id == event_id
-    ).all()
+    ).first()
     
-    if existing_assignments:
+    if existing_assignment:
         raise HTTPException(status_code=400, detail="Назначения для этого мероприятия уже существуют")
     
-    # Создаем случайные назначения
-    import random
-    random.shuffle(participant_ids)
-    
-    assignments = []
-    for i in range(len(participant_ids)):
-        giver_id = participant_ids[i]
-        receiver_id = participant_ids[(i + 1) % len(participant_ids)]  # Циклическое назначение
-        
-        assignment = GiftAssignment(
-            event_id=event_id,
-            giver_id=giver_id,
-            receiver_id=receiver_id,
-            is_approved=False
+    signature = participants_signature(participant_ids)
+    if preview_token:
+        # Предпросмотр одноразовый: повторная отправка того же токена ничего не создаст
+        preview = assignment_previews.pop(preview_token)
+        if preview is None or preview["event_id"] != event_id:
+            raise HTTPException(status_code=404, detail="Предпросмотр не найден или устарел, сгенерируйте заново")
+        if preview["signature"] != signature:
+            raise HTTPException(status_code=409, detail="Состав участников изменился после предпросмотра, сгенерируйте заново")
+        pairs = preview["pairs"]
+    else:
+        # Ищем цикл «даритель -> получатель» без запрещенных пар
+        forbidden_pairs, groups = collect_assignment_exclusions(db, event_id, participant_ids, options)
+        try:
+            pairs = solve_gift_assignments(participant_ids, forbidden_pairs, groups)
+        except NoValidAssignment as e:
+            raise HTTPException(status_code=400, detail=f"Невозможно распределить подарки: {e.reason}")
+    
+    if dry_run:
+        token = token_urlsafe(24)
+        assignment_previews.set(
+            token,
+            {"event_id": event_id, "signature": signature, "pairs": pairs},
+            GIFT_ASSIGNMENT_PREVIEW_TTL_SECONDS
         )
-        assignments.append(assignment)
-    
-    # Сохраняем в базу данных
-    for assignment in assignments:
-        db.add(assignment)
+        return {"preview_token": token, "expires_in": GIFT_ASSIGNMENT_PREVIEW_TTL_SECONDS, "pairs": pairs}
     
+    # Все назначения одним executemany в одной транзакции, без объектов ORM
+    now = datetime.utcnow()
+    db.execute(GiftAssignment.__table__.insert(), [
+        {"event_id": event_id, "giver_id": giver_id, "receiver_id": receiver_id, "is_approved": False, "created_at": now}
+        for giver_id, receiver_id in pairs
+    ])
     db.commit()
-    return assignments
-
-def get_gift_assignments_with_details(event_id: int, db: Session):
-    """Получает назначения подарков с подробной информацией о пользователях"""
-    assignments = db.query(GiftAssignment).filter(
-        GiftAssignment.event_id == event_id
-    ).all()
-    
-    result = []
-    for assignment in assignments:
-        # Получаем информацию о дарителе
-        giver = db.query(User).filter(User.id == assignment.giver_id).first()
-        # Получаем информацию о получателе
-        receiver = db.query(User).filter(User.id == assignment.receiver_id).first()
-        
-        assignment_data = {
-            "id": assignment.id,
-            "event_id": assignment.event_id,
-            "giver_id": assignment.giver_id,
-            "receiver_id": assignment.receiver_id,
-            "is_approved": assignment.is_approved,
-            "created_at": assignment.created_at,
-            "approved_at": assignment.approved_at,
-            "approved_by": assignment.approved_by,
-            "giver_name": giver.full_name or giver.name if giver else None,
-            "giver_email": giver.email if giver else None,
-            "receiver_name": receiver.full_name or receiver.name if receiver else None,
-            "receiver_email": receiver.email if receiver else None,
-            "receiver_address": receiver.address if receiver else None
-        }
-        result.append(assignment_data)
-    
-    return result
+    return {"pairs": pairs}
+
+def gift_assignment_rows_query(db: Session, event_id: int, is_approved: bool | None = None):
+    """Назначения мероприятия с данными дарителя и получателя одним запросом (users дважды под псевдонимами)"""
+    giver = aliased(User)
+    receiver = aliased(User)
+    query = db.query(
+        GiftAssignment.id,
+        GiftAssignment.event_id,
+        GiftAssignment.giver_id,
+        GiftAssignment.receiver_id,
+        GiftAssignment.is_approved,
+        GiftAssignment.created_at,
+        GiftAssignment.approved_at,
+        GiftAssignment.approved_by,
+        func.coalesce(giver.full_name, giver.name).label("giver_name"),
+        giver.email.label("giver_email"),
+        func.coalesce(receiver.full_name, receiver.name).label("receiver_name"),
+        receiver.email.label("receiver_email"),
+        receiver.address.label("receiver_address"),
+    ).outerjoin(giver, giver.id == GiftAssignment.giver_id).outerjoin(
+        receiver, receiver.id == GiftAssignment.receiver_id
+    ).filter(GiftAssignment.event_id == event_id)
+    if is_approved is not None:
+        query = query.filter(GiftAssignment.is_approved == is_approved)
+    return query.order_by(GiftAssignment.id)
+
+
+# Поля, доступные для выборки в списке пользователей (fields=...)
+USER_LIST_FIELDS = tuple(UserResponse.model_fields)
+USER_LIST_MAX_LIMIT = 500
+
+def parse_user_fields(fields: str | None) -> list[str]:
+    """Разбирает параметр fields; id включается всегда, так как по нему идет пагинация"""
+    if not fields:
+        return list(USER_LIST_FIELDS)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in USER_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные поля: {', '.join(unknown)}")
+    return ["id"] + [field for field in dict.fromkeys(requested) if field != "id"]
 
-@app.get("/users/", response_model=list[UserResponse])
+@app.get("/users/")
 async def get_users(
+    response: Response,
+    cursor: int | None = Query(None, description="id последнего пользователя предыдущей страницы"),
+    limit: int = Query(100, ge=1, le=USER_LIST_MAX_LIMIT),
+    fields: str | None = Query(None, description="Список полей через запятую"),
+    role: str | None = None,
+    is_active: bool | None = None,
+    gwars_verified: bool | None = None,
+    is_test: bool | None = None,
+    profile_completed: bool | None = None,
     authorization: str | None = Header(None, alias="Authorization"),
     db: Session = Depends(get_db)
 ):
-    """Получение списка пользователей (доступно всем, включая неавторизованных)"""
+    """Получение списка пользователей (доступно всем, включая неавторизованных)
+    
+    Постраничная выдача по id: курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+    """
     current_user = None
     
     # Пытаемся получить текущего пользователя, если токен передан
     if authorization and authorization.startswith("Bearer "):
-        try:
-            token = authorization.replace("Bearer ", "").strip()
-            if token:
-                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-                email: str = payload.get("sub")
-                if email:
-                    current_user = db.query(User).filter(User.email == email).first()
-        except (JWTError, Exception):
-            # Игнорируем ошибки авторизации - неавторизованные пользователи тоже могут видеть список
-            pass
+        token = authorization.replace("Bearer ", "").strip()
+        if token:
+            # Неавторизованные пользователи тоже могут видеть список, ошибки токена игнорируем
+            current_user = resolve_principal(token, db)
+    
+    selected_fields = parse_user_fields(fields)
+    # Выбираем только нужные колонки, без загрузки ORM-объектов
+    query = db.query(*[getattr(User, field) for field in selected_fields])
     
     # Администраторы видят всех пользователей, остальные - только активных
-    if current_user and current_user.role == "admin":
-        users = db.query(User).all()
+    if not (current_user and current_user.role == "admin"):
+        if is_active is False:
+            return []
+        is_active = True
+    
+    if role is not None:
+        query = query.filter(User.role == role)
+    if is_active is not None:
+        query = query.filter(User.is_active == is_active)
+    if gwars_verified is not None:
+        query = query.filter(User.gwars_verified == gwars_verified)
+    if is_test is not None:
+        query = query.filter(User.is_test == is_test)
+    if profile_completed is not None:
+        query = query.filter(User.profile_completed == profile_completed)
+    if cursor is not None:
+        query = query.filter(User.id > cursor)
+    
+    rows = query.order_by(User.id).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    return [dict(row._mapping) for row in rows]
+
+def build_user_search_match(query: str) -> tuple[str | None, list[str]]:
+    """Строит выражение MATCH для FTS5; пользовательский ввод экранируется как фразы
+
+    Возвращает выражение и короткие термы, которые триграммный индекс не находит.
+    """
+    terms = [term for term in query.split() if term]
+    if USER_SEARCH_MODE == "trigram":
+        # Триграммный индекс находит только подстроки от 3 символов, короткие термы ищем по префиксу
+        phrases = [term.replace('"', '""') for term in terms if len(term) >= 3]
+        short_terms = [term for term in terms if len(term) < 3]
+        return " AND ".join(f'"{term}"' for term in phrases) or None, short_terms
+    phrases = [term.replace('"', '""') for term in terms]
+    return " AND ".join(f'"{term}"*' for term in phrases) or None, []
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@app.get("/admin/users/search")
+async def search_users(
+    response: Response,
+    q: str = Query(..., min_length=1, description="Строка поиска по email, имени, никнейму и ФИО"),
+    cursor: int | None = Query(None, ge=0, description="Смещение следующей страницы из X-Next-Cursor"),
+    limit: int = Query(50, ge=1, le=USER_LIST_MAX_LIMIT),
+    fields: str | None = Query(None, description="Список полей через запятую"),
+    current_admin: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """Поиск пользователей по полнотекстовому индексу с ранжированием (только для администраторов)"""
+    selected_fields = parse_user_fields(fields)
+    offset = cursor or 0
+    query = db.query(*[getattr(User, field) for field in selected_fields])
+    
+    if USER_SEARCH_MODE:
+        match_expression, short_terms = build_user_search_match(q)
+        if match_expression:
+            query = query.join(users_fts_table, users_fts_table.c.rowid == User.id).filter(
+                text("users_fts MATCH :match")
+            ).params(match=match_expression).order_by(users_fts_table.c.rank, User.id)
+        else:
+            query = query.order_by(User.id)
+        # Термы короче триграммы: поиск по началу значения любого из полей.
+        # LIKE в SQLite не учитывает регистр только для ASCII, поэтому кириллицу перебираем в вариантах регистра
+        for term in short_terms:
+            patterns = {f"{escape_like(variant)}%" for variant in (term, term.lower(), term.capitalize(), term.upper())}
+            query = query.filter(or_(*[
+                getattr(User, column).like(pattern, escape="\\")
+                for column in USER_SEARCH_COLUMNS for pattern in patterns
+            ]))
     else:
-        users = db.query(User).filter(User.is_active == True).all()
-    return users
+        # Нет FTS5: поиск подстроки без индекса
+        pattern = f"%{escape_like(q.strip())}%"
+        query = query.filter(or_(*[
+            getattr(User, column).like(pattern, escape="\\") for column in USER_SEARCH_COLUMNS
+        ])).order_by(User.id)
+    
+    rows = query.offset(offset).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(offset + limit)
+    return [dict(row._mapping) for row in rows]
+
+@app.get("/users/public")
+async def get_public_users(request: Request, db: Session = Depends(get_db)):
+    """Получение публичного списка пользователей с игровой информацией"""
+    body, etag = public_user_directory.get(db)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/users/{user_id}/public", response_model=UserResponse)
 async def get_user_public(user_id: int, db: Session = Depends(get_db)):
@@ -1718,10 +3176,7 @@ async def update_profile_step1(
     
     # Проверяем уникальность ссылки на игровой профиль
     # Исключаем текущего пользователя из проверки
-    existing_user = db.query(User).filter(
-        User.gwars_profile_url == profile_url,
-        User.id != current_user.id
-    ).first()
+    existing_user = find_gwars_profile_owner(db, profile_url, current_user.id)
     
     if existing_user:
         masked_email = mask_email(existing_user.email)
@@ -1810,31 +3265,99 @@ async def create_event(
     )
     db.add(db_event)
     db.commit()
+    current_event_cache.invalidate()
+    event_scheduler.request_reload()
     db.refresh(db_event)
     return db_event
 
-@app.get("/events/", response_model=list[EventResponse])
-async def get_events(db: Session = Depends(get_db)):
-    """Получение списка всех мероприятий"""
-    events = db.query(Event).order_by(Event.created_at.desc()).all()
+@app.get("/events/", response_model=list[EventListItemResponse])
+async def get_events(
+    response: Response,
+    cursor: int | None = Query(None, description="id последнего мероприятия предыдущей страницы"),
+    limit: int = Query(100, ge=1, le=USER_LIST_MAX_LIMIT),
+    active: bool | None = Query(None, description="Только включенные (true) или выключенные (false)"),
+    past: bool | None = Query(None, description="Только завершенные (true) или незавершенные (false)"),
+    db: Session = Depends(get_db)
+):
+    """Получение списка мероприятий, новые первыми
+    
+    Счетчики участников и состояние назначений приходят вместе с мероприятием одним запросом.
+    Курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+    """
+    assignments_count = func.count(GiftAssignment.id)
+    approved_assignments_count = func.coalesce(func.sum(case((GiftAssignment.is_approved == True, 1), else_=0)), 0)
+    query = db.query(
+        *Event.__table__.c,
+        func.coalesce(EventStats.preregistered_count, 0).label("preregistered_count"),
+        func.coalesce(EventStats.confirmed_count, 0).label("confirmed_count"),
+        assignments_count.label("assignments_count"),
+        approved_assignments_count.label("approved_assignments_count"),
+    ).select_from(Event).outerjoin(
+        EventStats, EventStats.event_id == Event.id
+    ).outerjoin(
+        GiftAssignment, GiftAssignment.event_id == Event.id
+    ).group_by(Event.id)
+    
+    if active is not None:
+        query = query.filter(Event.is_active == active)
+    if past is not None:
+        now = datetime.utcnow()
+        query = query.filter(Event.registration_end <= now if past else Event.registration_end > now)
+    if cursor is not None:
+        query = query.filter(Event.id < cursor)
+    
+    rows = query.order_by(Event.id.desc()).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    
+    events = []
+    for row in rows:
+        item = dict(row._mapping)
+        item["participants_count"] = item["preregistered_count"] + item["confirmed_count"]
+        if not item["assignments_count"]:
+            item["assignment_status"] = "none"
+        elif item["approved_assignments_count"] == item["assignments_count"]:
+            item["assignment_status"] = "approved"
+        else:
+            item["assignment_status"] = "pending"
+        events.append(item)
     return events
 
+# Счетчики участников меняются чаще границ фаз, поэтому в кэшируемый ответ не входят
+CURRENT_EVENT_EXCLUDED_FIELDS = {"preregistered_count", "confirmed_count", "participants_count"}
+
 @app.get("/events/current", response_model=EventResponse | None)
 async def get_current_event(db: Session = Depends(get_db)):
     """Получение ближайшего активного мероприятия"""
-    now = datetime.utcnow()
-    
-    # Ищем активные мероприятия, которые еще не завершились
-    active_events = db.query(Event).filter(
-        Event.is_active == True,
-        Event.registration_end > now
-    ).order_by(Event.preregistration_start.asc()).all()
-    
-    if not active_events:
-        return None
+    cached = current_event_cache.get()
+    if cached is None:
+        generation = current_event_cache.generation
+        now = datetime.utcnow()
+        
+        # Активные мероприятия, которые еще не завершились; одновременно их совсем немного
+        active_events = db.query(Event).filter(
+            Event.is_active == True,
+            Event.registration_end > now
+        ).order_by(Event.preregistration_start.asc()).all()
+        
+        # Ближайшее мероприятие (или null) и момент, когда ответ может измениться
+        current = active_events[0] if active_events else None
+        payload = EventResponse.model_validate(current, from_attributes=True).model_dump(
+            mode="json", exclude=CURRENT_EVENT_EXCLUDED_FIELDS
+        ) if current else None
+        boundaries = [
+            moment
+            for active_event in active_events
+            for moment in (active_event.preregistration_start, active_event.registration_start, active_event.registration_end)
+            if moment and moment > now
+        ]
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        cached = current_event_cache.put(body, min(boundaries, default=None), generation)
     
-    # Возвращаем ближайшее мероприятие
-    return active_events[0]
+    body, expires_at = cached
+    max_age = max(0, int((expires_at - datetime.utcnow()).total_seconds()))
+    return Response(content=body, media_type="application/json", headers={"Cache-Control": f"max-age={max_age}"})
 
 @app.get("/events/{event_id}", response_model=EventResponse)
 async def get_event(event_id: int, db: Session = Depends(get_db)):
@@ -1852,83 +3375,189 @@ async def get_event_by_unique_id(unique_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Event not found")
     return event
 
+PARTICIPANT_STATUSES = {"confirmed": True, "preregistered": False}
+
+def list_event_participants(
+    event_id: int,
+    registration_version: int,
+    request: Request,
+    cursor: int | None,
+    limit: int,
+    status: str | None,
+    db: Session
+) -> Response:
+    """Участники мероприятия одним запросом с JOIN; курсор — id последней регистрации страницы"""
+    if status is not None and status not in PARTICIPANT_STATUSES:
+        raise HTTPException(status_code=400, detail="Статус должен быть confirmed или preregistered")
+    
+    # Никнеймы и аватарки тоже попадают в ответ — учитываем версию публичного списка пользователей
+    _, directory_etag = public_user_directory.get(db)
+    etag_source = f"{event_id}:{registration_version}:{directory_etag}:{status}:{cursor}:{limit}"
+    etag = f'"{hashlib.sha256(etag_source.encode()).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    query = db.query(
+        EventRegistration.id.label("registration_id"),
+        EventRegistration.is_confirmed,
+        EventRegistration.registration_type,
+        User.id,
+        User.gwars_nickname,
+        User.gwars_profile_url,
+        User.avatar_seed
+    ).join(User, User.id == EventRegistration.user_id).filter(EventRegistration.event_id == event_id)
+    if status is not None:
+        query = query.filter(EventRegistration.is_confirmed == PARTICIPANT_STATUSES[status])
+    if cursor is not None:
+        query = query.filter(EventRegistration.id > cursor)
+    rows = query.order_by(EventRegistration.id).limit(limit + 1).all()
+    
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = str(rows[-1].registration_id)
+    
+    participants_list = [
+        participant_entry(row, row.is_confirmed, row.registration_type)
+        for row in rows
+    ]
+    return JSONResponse(content=participants_list, headers=headers)
+
+def participant_entry(user, is_confirmed: bool, registration_type: str) -> dict:
+    """Элемент списка участников (и дельт SSE-потока)"""
+    return {
+        "id": user.id,
+        "nickname": user.gwars_nickname or "Неизвестно",
+        "gwars_nickname": user.gwars_nickname,
+        "gwars_profile_url": user.gwars_profile_url,
+        "avatar_seed": user.avatar_seed,
+        "status": "confirmed" if is_confirmed else "preregistered",
+        "status_text": "Подтвержден" if is_confirmed else "Предварительная регистрация",
+        "registration_type": registration_type
+    }
+
 @app.get("/events/{event_id}/participants")
-async def get_event_participants(event_id: int, db: Session = Depends(get_db)):
+async def get_event_participants(
+    event_id: int,
+    request: Request,
+    cursor: int | None = Query(None, description="id последней регистрации предыдущей страницы"),
+    limit: int = Query(100, ge=1, le=USER_LIST_MAX_LIMIT),
+    status: str | None = Query(None, description="confirmed или preregistered"),
+    db: Session = Depends(get_db)
+):
     """Получение списка участников мероприятия"""
-    # Проверяем, что мероприятие существует
-    event = db.query(Event).filter(Event.id == event_id).first()
+    event = db.query(Event.id, Event.registration_version).filter(Event.id == event_id).first()
     if not event:
         raise HTTPException(status_code=404, detail="Мероприятие не найдено")
-    
-    # Получаем всех участников мероприятия через EventRegistration
-    registrations = db.query(EventRegistration).filter(
-        EventRegistration.event_id == event_id
-    ).all()
-    
-    # Формируем список участников с никнеймом, ссылкой на профиль и статусом
-    participants_list = []
-    for registration in registrations:
-        # Получаем пользователя
-        user = db.query(User).filter(User.id == registration.user_id).first()
-        if user:
-            # Используем сохраненный никнейм из GWars профиля
-            nickname = user.gwars_nickname or "Неизвестно"
-            
-            # Определяем статус участника
-            status = "confirmed" if registration.is_confirmed else "preregistered"
-            status_text = "Подтвержден" if registration.is_confirmed else "Предварительная регистрация"
-            
-            participants_list.append({
-                "id": user.id,
-                "nickname": nickname,
-                "gwars_nickname": user.gwars_nickname,
-                "gwars_profile_url": user.gwars_profile_url,
-                "avatar_seed": user.avatar_seed,
-                "status": status,
-                "status_text": status_text,
-                "registration_type": registration.registration_type
-            })
-    
-    return participants_list
+    return list_event_participants(event.id, event.registration_version, request, cursor, limit, status, db)
 
 @app.get("/events/unique/{unique_id}/participants")
-async def get_event_participants_by_unique_id(unique_id: int, db: Session = Depends(get_db)):
+async def get_event_participants_by_unique_id(
+    unique_id: int,
+    request: Request,
+    cursor: int | None = Query(None, description="id последней регистрации предыдущей страницы"),
+    limit: int = Query(100, ge=1, le=USER_LIST_MAX_LIMIT),
+    status: str | None = Query(None, description="confirmed или preregistered"),
+    db: Session = Depends(get_db)
+):
     """Получение списка участников мероприятия по уникальному ID"""
-    # Находим мероприятие по уникальному ID
-    event = db.query(Event).filter(Event.unique_id == unique_id).first()
+    event = db.query(Event.id, Event.registration_version).filter(Event.unique_id == unique_id).first()
     if not event:
         raise HTTPException(status_code=404, detail="Мероприятие не найдено")
+    return list_event_participants(event.id, event.registration_version, request, cursor, limit, status, db)
+
+# Счетчики для сверки потоков: все подписчики мероприятия делят один запрос за интервал keepalive
+event_stream_counts_cache = TTLCache(max_size=1024)
+
+def load_event_stream_counts(event_id: int) -> dict | None:
+    counts = event_stream_counts_cache.get(event_id)
+    if counts is not None:
+        return counts
+    db = SessionLocal()
+    try:
+        row = db.query(
+            Event.registration_version,
+            func.coalesce(EventStats.preregistered_count, 0).label("preregistered_count"),
+            func.coalesce(EventStats.confirmed_count, 0).label("confirmed_count"),
+        ).outerjoin(EventStats, EventStats.event_id == Event.id).filter(Event.id == event_id).first()
+    finally:
+        db.close()
+    if row is None:
+        return None
+    counts = dict(row._mapping)
+    event_stream_counts_cache.set(event_id, counts, EVENT_STREAM_KEEPALIVE_SECONDS / 2)
+    return counts
+
+def event_stream_snapshot(event: Event) -> dict:
+    """Первое сообщение потока: границы фаз для обратного отсчета и текущие счетчики"""
+    return {
+        "id": event.id,
+        "server_time": datetime.utcnow(),
+        "preregistration_start": event.preregistration_start,
+        "registration_start": event.registration_start,
+        "registration_end": event.registration_end,
+        "event_start": event.event_start,
+        "is_active": event.is_active,
+        "registration_version": event.registration_version,
+        "preregistered_count": event.preregistered_count,
+        "confirmed_count": event.confirmed_count,
+    }
+
+@app.get("/events/{event_id}/stream")
+async def stream_event(event_id: int, request: Request, db: Session = Depends(get_db)):
+    """SSE-поток изменений мероприятия вместо опроса /participants и /events/current
     
-    # Получаем всех участников мероприятия через EventRegistration
-    registrations = db.query(EventRegistration).filter(
-        EventRegistration.event_id == event.id  # Используем внутренний ID
-    ).all()
+    События: snapshot (при подключении), joined и confirmed (участник с дельтой счетчиков),
+    counts (сверка с БД, если список менялся в другом воркере), event_updated, event_deleted.
+    """
+    if not EVENT_STREAM_ENABLED:
+        raise HTTPException(status_code=404, detail="Поток изменений мероприятий выключен")
+    event = db.query(Event).filter(Event.id == event_id).first()
+    if not event:
+        raise HTTPException(status_code=404, detail="Мероприятие не найдено")
+    snapshot = event_stream_snapshot(event)
+    # Соединение с БД на все время потока не держим
+    db.close()
     
-    # Формируем список участников с никнеймом, ссылкой на профиль и статусом
-    participants_list = []
-    for registration in registrations:
-        # Получаем пользователя
-        user = db.query(User).filter(User.id == registration.user_id).first()
-        if user:
-            # Используем сохраненный никнейм из GWars профиля
-            nickname = user.gwars_nickname or "Неизвестно"
-            
-            # Определяем статус участника
-            status = "confirmed" if registration.is_confirmed else "preregistered"
-            status_text = "Подтвержден" if registration.is_confirmed else "Предварительная регистрация"
-            
-            participants_list.append({
-                "id": user.id,
-                "nickname": nickname,
-                "gwars_nickname": user.gwars_nickname,
-                "gwars_profile_url": user.gwars_profile_url,
-                "avatar_seed": user.avatar_seed,
-                "status": status,
-                "status_text": status_text,
-                "registration_type": registration.registration_type
-            })
+    queue = event_stream_bus.subscribe(event_id)
+    if queue is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Слишком много подключений, попробуйте позже",
+            headers={"Retry-After": str(EVENT_STREAM_KEEPALIVE_SECONDS)}
+        )
+    
+    async def stream():
+        try:
+            version = snapshot["registration_version"]
+            yield "retry: 5000\n" + sse_message("snapshot", snapshot)
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), EVENT_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    counts = await run_in_threadpool(load_event_stream_counts, event_id)
+                    if counts is None:
+                        yield sse_message("event_deleted", {"id": event_id})
+                        break
+                    if counts["registration_version"] != version:
+                        version = counts["registration_version"]
+                        yield sse_message("counts", counts)
+                    else:
+                        yield ": ping\n\n"
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            event_stream_bus.unsubscribe(event_id, queue)
     
-    return participants_list
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/events/{event_id}/user-registration")
 async def get_user_registration(
@@ -1976,6 +3605,9 @@ async def update_event(
     
     # Обновляем только переданные поля
     if event_update.name is not None:
+        if event_update.name != event.name:
+            # Название мероприятия входит в назначения участников
+            bump_assignment_versions(db.connection(), assignment_user_ids(GiftAssignment.event_id == event_id))
         event.name = event_update.name
     if event_update.description is not None:
         event.description = event_update.description
@@ -1989,7 +3621,10 @@ async def update_event(
         event.is_active = event_update.is_active
     
     db.commit()
+    current_event_cache.invalidate()
+    event_scheduler.request_reload()
     db.refresh(event)
+    event_stream_bus.publish(event_id, "event_updated", event_stream_snapshot(event))
     return event
 
 @app.delete("/events/{event_id}")
@@ -1998,47 +3633,154 @@ async def delete_event(
     current_admin: User = Depends(get_current_admin),
     db: Session = Depends(get_db)
 ):
-    """Удаление мероприятия (только для администраторов)"""
+    """Удаление мероприятия (только для администраторов)
+    
+    Мероприятие сразу помечается удаленным и пропадает из выдачи; регистрации и назначения
+    удаляются в фоне пачками, не удерживая блокировку записи SQLite.
+    """
     event = db.query(Event).filter(Event.id == event_id).first()
     if not event:
         raise HTTPException(status_code=404, detail="Event not found")
     
-    db.delete(event)
+    event.deleted_at = datetime.utcnow()
+    bump_assignment_versions(db.connection(), assignment_user_ids(GiftAssignment.event_id == event_id))
+    db.query(EventStats).filter(EventStats.event_id == event_id).delete(synchronize_session=False)
     db.commit()
+    current_event_cache.invalidate()
+    event_scheduler.request_reload()
+    event_stream_bus.publish(event_id, "event_deleted", {"id": event_id})
+    event_stream_bus.close(event_id)
+    schedule_event_purge(event_id)
     return {"message": "Event deleted successfully"}
 
-# API endpoints для регистрации на мероприятия
-@app.post("/events/{event_id}/register", response_model=EventRegistrationResponse)
-async def register_for_event(
-    event_id: int,
-    registration_data: EventRegistrationCreate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+def purge_event_rows(event_id: int, batch_size: int = EVENT_PURGE_BATCH_SIZE, pause_ms: int = EVENT_PURGE_PAUSE_MS) -> int:
+    """Удаляет назначения и регистрации удаленного мероприятия, затем само мероприятие
+    
+    Каждая пачка — отдельная короткая транзакция DELETE ... WHERE id IN (SELECT ... LIMIT n).
+    """
+    removed = 0
+    for model in (GiftAssignment, EventRegistration):
+        while True:
+            chunk = select(model.id).where(model.event_id == event_id).limit(batch_size).scalar_subquery()
+            with engine.begin() as conn:
+                deleted = conn.execute(delete(model).where(model.id.in_(chunk))).rowcount
+            removed += deleted
+            if deleted < batch_size:
+                break
+            time.sleep(pause_ms / 1000)
+    with engine.begin() as conn:
+        conn.execute(delete(EventStats).where(EventStats.event_id == event_id))
+        conn.execute(delete(Event).where(Event.id == event_id, Event.deleted_at.isnot(None)))
+    return removed
+
+# Очистка идет в одном фоновом потоке, удаления разных мероприятий не пересекаются
+event_purge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="event-purge")
+
+def schedule_event_purge(event_id: int):
+    def job():
+        try:
+            removed = purge_event_rows(event_id)
+            print(f"Мероприятие {event_id} очищено: удалено строк {removed}")
+        except Exception as e:
+            print(f"Ошибка очистки мероприятия {event_id}: {e}")
+    return event_purge_executor.submit(job)
+
+event_purges_resumed = False
+event_purges_resume_lock = threading.Lock()
+
+def resume_event_purges():
+    """Дочищает мероприятия, удаление которых прервал перезапуск; выполняется один раз за процесс
+
+    WSGI-адаптер не вызывает startup-хуки, поэтому вызов повторяется лениво — при запросах
+    администратора и при удалении мероприятия.
+    """
+    global event_purges_resumed
+    if event_purges_resumed:
+        return
+    with event_purges_resume_lock:
+        if event_purges_resumed:
+            return
+        db = SessionLocal()
+        try:
+            pending = db.query(Event.id).filter(Event.deleted_at.isnot(None)).execution_options(
+                include_deleted_events=True
+            ).all()
+        finally:
+            db.close()
+        event_purges_resumed = True
+    for (event_id,) in pending:
+        schedule_event_purge(event_id)
+
+@app.on_event("startup")
+async def resume_event_purges_on_startup():
+    resume_event_purges()
+
+def bump_registration_version(connection, event_id: int):
+    connection.execute(
+        update(Event)
+        .where(Event.id == event_id)
+        .values(registration_version=Event.registration_version + 1)
+    )
+
+def insert_event_registration(connection, values: dict) -> dict | None:
+    """INSERT ... ON CONFLICT DO NOTHING RETURNING; None — пользователь уже зарегистрирован"""
+    statement = sqlite_insert(EventRegistration).values(**values).on_conflict_do_nothing(
+        index_elements=[EventRegistration.user_id, EventRegistration.event_id]
+    ).returning(*EventRegistration.__table__.c)
+    row = connection.execute(statement).first()
+    if row is None:
+        return None
+    # Core INSERT идет в обход событий ORM — версию и счетчики обновляем в той же транзакции
+    bump_registration_version(connection, values["event_id"])
+    if values["is_confirmed"]:
+        apply_event_stats_delta(connection, values["event_id"], 0, 1)
+    else:
+        apply_event_stats_delta(connection, values["event_id"], 1, 0)
+    return dict(row._mapping)
+
+def confirm_event_registration(connection, registration_id: int, event_id: int, confirmed_address: str, now: datetime) -> dict | None:
+    """Подтверждает регистрацию одним UPDATE ... RETURNING; None — уже подтверждена"""
+    row = connection.execute(
+        update(EventRegistration)
+        .where(EventRegistration.id == registration_id, EventRegistration.is_confirmed == False)
+        .values(is_confirmed=True, confirmed_address=confirmed_address, confirmed_at=now)
+        .returning(*EventRegistration.__table__.c)
+    ).first()
+    if row is None:
+        return None
+    bump_registration_version(connection, event_id)
+    apply_event_stats_delta(connection, event_id, -1, 1)
+    return dict(row._mapping)
+
+async def write_registration(db: Session, func, *args):
+    """Выполняет запись регистрации: через пакетного писателя в режиме пиковой нагрузки или сразу"""
+    if registration_writer.enabled:
+        # Возвращаем соединение сессии в пул на время ожидания писателя
+        db.close()
+        return await registration_writer.submit(func, *args)
+    result = func(db.connection(), *args)
+    db.commit()
+    return result
+
+async def register_user_for_event(
+    event: Event | None,
+    current_user: User,
+    registration_type: str,
+    idempotency_key: str | None,
+    db: Session
 ):
-    """Регистрация пользователя на мероприятие"""
+    """Регистрирует пользователя одним INSERT ... ON CONFLICT DO NOTHING RETURNING"""
     # Проверяем, что пользователь авторизован и профиль заполнен
     if not current_user.profile_completed:
         raise HTTPException(status_code=400, detail="Профиль должен быть полностью заполнен")
     
-    # Проверяем существование мероприятия
-    event = db.query(Event).filter(Event.id == event_id).first()
     if not event:
         raise HTTPException(status_code=404, detail="Мероприятие не найдено")
     
     if not event.is_active:
         raise HTTPException(status_code=400, detail="Мероприятие неактивно")
     
-    # Проверяем, что пользователь еще не зарегистрирован
-    existing_registration = db.query(EventRegistration).filter(
-        EventRegistration.user_id == current_user.id,
-        EventRegistration.event_id == event_id
-    ).first()
-    
-    if existing_registration:
-        raise HTTPException(status_code=400, detail="Вы уже зарегистрированы на это мероприятие")
-    
     now = datetime.utcnow()
-    registration_type = registration_data.registration_type
     
     # Проверяем даты в зависимости от типа регистрации
     if registration_type == "preregistration":
@@ -2054,85 +3796,58 @@ async def register_for_event(
     else:
         raise HTTPException(status_code=400, detail="Неверный тип регистрации")
     
-    # Создаем регистрацию
-    registration = EventRegistration(
-        user_id=current_user.id,
-        event_id=event_id,
-        registration_type=registration_type,
-        is_confirmed=(registration_type == "registration")  # Если прямая регистрация, сразу подтверждаем
-    )
-    
-    if registration_type == "registration":
-        registration.confirmed_address = current_user.address
-        registration.confirmed_at = now
+    # Если прямая регистрация, сразу подтверждаем
+    is_confirmed = registration_type == "registration"
+    row = await write_registration(db, insert_event_registration, {
+        "user_id": current_user.id,
+        "event_id": event.id,
+        "registration_type": registration_type,
+        "is_confirmed": is_confirmed,
+        "confirmed_address": current_user.address if is_confirmed else None,
+        "confirmed_at": now if is_confirmed else None,
+        "created_at": now,
+        "idempotency_key": idempotency_key,
+    })
     
-    db.add(registration)
-    db.commit()
-    db.refresh(registration)
-    return registration
+    if row is None:
+        # Пользователь уже зарегистрирован: повтор запроса с тем же ключом возвращает ту же регистрацию
+        existing_registration = db.query(EventRegistration).filter(
+            EventRegistration.user_id == current_user.id,
+            EventRegistration.event_id == event.id
+        ).first()
+        if existing_registration and idempotency_key and existing_registration.idempotency_key == idempotency_key:
+            return existing_registration
+        raise HTTPException(status_code=400, detail="Вы уже зарегистрированы на это мероприятие")
+    event_stream_bus.publish(event.id, "joined", {
+        "participant": participant_entry(current_user, is_confirmed, registration_type),
+        "delta": {"preregistered_count": 0 if is_confirmed else 1, "confirmed_count": 1 if is_confirmed else 0},
+    })
+    return row
+
+# API endpoints для регистрации на мероприятия
+@app.post("/events/{event_id}/register", response_model=EventRegistrationResponse)
+async def register_for_event(
+    event_id: int,
+    registration_data: EventRegistrationCreate,
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key", max_length=255),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Регистрация пользователя на мероприятие"""
+    event = db.query(Event).filter(Event.id == event_id).first()
+    return await register_user_for_event(event, current_user, registration_data.registration_type, idempotency_key, db)
 
 @app.post("/events/unique/{unique_id}/register", response_model=EventRegistrationResponse)
 async def register_for_event_by_unique_id(
     unique_id: int,
     registration_data: EventRegistrationCreate,
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key", max_length=255),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Регистрация пользователя на мероприятие по уникальному ID"""
-    # Проверяем, что пользователь авторизован и профиль заполнен
-    if not current_user.profile_completed:
-        raise HTTPException(status_code=400, detail="Профиль должен быть полностью заполнен")
-    
-    # Находим мероприятие по уникальному ID
     event = db.query(Event).filter(Event.unique_id == unique_id).first()
-    if not event:
-        raise HTTPException(status_code=404, detail="Мероприятие не найдено")
-    
-    if not event.is_active:
-        raise HTTPException(status_code=400, detail="Мероприятие неактивно")
-    
-    # Проверяем, что пользователь еще не зарегистрирован
-    existing_registration = db.query(EventRegistration).filter(
-        EventRegistration.user_id == current_user.id,
-        EventRegistration.event_id == event.id
-    ).first()
-    
-    if existing_registration:
-        raise HTTPException(status_code=400, detail="Вы уже зарегистрированы на это мероприятие")
-    
-    now = datetime.utcnow()
-    registration_type = registration_data.registration_type
-    
-    # Проверяем даты в зависимости от типа регистрации
-    if registration_type == "preregistration":
-        if now < event.preregistration_start:
-            raise HTTPException(status_code=400, detail="Предварительная регистрация еще не началась")
-        if now >= event.registration_start:
-            raise HTTPException(status_code=400, detail="Предварительная регистрация уже закончилась")
-    elif registration_type == "registration":
-        if now < event.registration_start:
-            raise HTTPException(status_code=400, detail="Регистрация еще не началась")
-        if now >= event.registration_end:
-            raise HTTPException(status_code=400, detail="Регистрация уже закончилась")
-    else:
-        raise HTTPException(status_code=400, detail="Неверный тип регистрации")
-    
-    # Создаем регистрацию
-    registration = EventRegistration(
-        user_id=current_user.id,
-        event_id=event.id,  # Используем внутренний ID для связи
-        registration_type=registration_type,
-        is_confirmed=(registration_type == "registration")  # Если прямая регистрация, сразу подтверждаем
-    )
-    
-    if registration_type == "registration":
-        registration.confirmed_address = current_user.address
-        registration.confirmed_at = now
-    
-    db.add(registration)
-    db.commit()
-    db.refresh(registration)
-    return registration
+    return await register_user_for_event(event, current_user, registration_data.registration_type, idempotency_key, db)
 
 @app.get("/events/{event_id}/registrations", response_model=list[EventRegistrationResponse])
 async def get_event_registrations(
@@ -2160,6 +3875,108 @@ async def get_user_registrations(
     ).all()
     return registrations
 
+def event_phase(event: Event, now: datetime) -> str:
+    """Фаза мероприятия: upcoming, preregistration, registration, ended
+
+    Незаполненная дата границы не ограничивает фазу; без даты окончания регистрация не заканчивается.
+    """
+    if event.preregistration_start and now < event.preregistration_start:
+        return "upcoming"
+    if event.registration_start and now < event.registration_start:
+        return "preregistration"
+    if not event.registration_end or now < event.registration_end:
+        return "registration"
+    return "ended"
+
+@app.get("/user/summary")
+async def get_user_summary(
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Сводка для главной страницы: регистрации с мероприятиями, статус профиля и утвержденные назначения
+    
+    Заменяет запросы к /user/registrations, /events/{id}, /profile/status и /user/gift-assignments.
+    """
+    now = datetime.utcnow()
+    
+    # Регистрации вместе с данными мероприятий
+    registration_rows = db.query(
+        EventRegistration.id,
+        EventRegistration.event_id,
+        EventRegistration.registration_type,
+        EventRegistration.is_confirmed,
+        EventRegistration.confirmed_address,
+        EventRegistration.confirmed_at,
+        EventRegistration.created_at,
+        Event.unique_id.label("event_unique_id"),
+        Event.name.label("event_name"),
+        Event.is_active.label("event_is_active"),
+        Event.preregistration_start,
+        Event.registration_start,
+        Event.registration_end,
+        Event.event_start,
+    ).join(Event, Event.id == EventRegistration.event_id).filter(
+        EventRegistration.user_id == current_user.id
+    ).order_by(Event.registration_end.desc()).all()
+    
+    registrations = []
+    for row in registration_rows:
+        item = dict(row._mapping)
+        item["event_phase"] = event_phase(row, now)
+        registrations.append(item)
+    profile = profile_status_payload(current_user)
+    
+    # ETag до чтения назначений: профиль и регистрации уже прочитаны, назначения представлены их версией
+    assignments_version = db.query(UserAssignmentVersion.version).filter(
+        UserAssignmentVersion.user_id == current_user.id
+    ).scalar() or 0
+    etag_source = json.dumps(
+        jsonable_encoder([current_user.id, assignments_version, profile, registrations]),
+        ensure_ascii=False, separators=(",", ":")
+    )
+    etag = f'"{hashlib.sha256(etag_source.encode()).hexdigest()[:32]}"'
+    # Ответ персональный: кэшировать можно только в браузере и только с повторной проверкой
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    # Утвержденные назначения, где пользователь дарит или получает, с именами второй стороны
+    giver = aliased(User)
+    receiver = aliased(User)
+    assignment_rows = db.query(
+        GiftAssignment.id,
+        GiftAssignment.event_id,
+        GiftAssignment.giver_id,
+        GiftAssignment.receiver_id,
+        GiftAssignment.approved_at,
+        Event.name.label("event_name"),
+        func.coalesce(giver.full_name, giver.name).label("giver_name"),
+        func.coalesce(receiver.full_name, receiver.name).label("receiver_name"),
+        receiver.address.label("receiver_address"),
+    ).join(Event, Event.id == GiftAssignment.event_id).join(
+        giver, giver.id == GiftAssignment.giver_id
+    ).join(
+        receiver, receiver.id == GiftAssignment.receiver_id
+    ).filter(
+        GiftAssignment.is_approved == True,
+        or_(GiftAssignment.giver_id == current_user.id, GiftAssignment.receiver_id == current_user.id)
+    ).order_by(GiftAssignment.id).all()
+    
+    assignments = []
+    for row in assignment_rows:
+        item = dict(row._mapping)
+        item["assignment_type"] = "giver" if row.giver_id == current_user.id else "receiver"
+        assignments.append(item)
+    
+    summary = {
+        "profile": profile,
+        "registrations": registrations,
+        "assignments": assignments,
+    }
+    body = json.dumps(jsonable_encoder(summary), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.post("/events/{event_id}/confirm", response_model=EventRegistrationResponse)
 async def confirm_registration(
     event_id: int,
@@ -2182,19 +3999,25 @@ async def confirm_registration(
     
     # Проверяем, что сейчас период основной регистрации
     event = db.query(Event).filter(Event.id == event_id).first()
+    if not event:
+        # Мероприятие удалено, а его регистрации еще ждут фоновой очистки
+        raise HTTPException(status_code=404, detail="Мероприятие не найдено")
     now = datetime.utcnow()
     
     if now < event.registration_start or now >= event.registration_end:
         raise HTTPException(status_code=400, detail="Сейчас не период подтверждения участия")
     
     # Подтверждаем участие
-    registration.is_confirmed = True
-    registration.confirmed_address = confirm_data.confirmed_address
-    registration.confirmed_at = now
-    
-    db.commit()
-    db.refresh(registration)
-    return registration
+    row = await write_registration(
+        db, confirm_event_registration, registration.id, event_id, confirm_data.confirmed_address, now
+    )
+    if row is None:
+        raise HTTPException(status_code=400, detail="Участие уже подтверждено")
+    event_stream_bus.publish(event_id, "confirmed", {
+        "participant": participant_entry(current_user, True, row["registration_type"]),
+        "delta": {"preregistered_count": -1, "confirmed_count": 1},
+    })
+    return row
 
 @app.post("/admin/promote/{user_id}")
 async def promote_user_to_admin(
@@ -2247,6 +4070,7 @@ async def block_user(
     
     user.is_active = False
     user.block_reason = block_request.reason
+    revoke_user_refresh_tokens(user.id, db)
     db.commit()
     db.refresh(user)
     return {"message": "User blocked successfully", "user": user}
@@ -2283,9 +4107,13 @@ async def delete_user(
         raise HTTPException(status_code=400, detail="Нельзя удалить самого себя")
     
     # Удаляем связанные данные (регистрации на мероприятия, подарки и т.д.)
-    db.query(EventRegistration).filter(EventRegistration.user_id == user.id).delete()
+    delete_user_registrations(db, [user.id])
+    bump_assignment_versions(db.connection(), assignment_user_ids(
+        or_(GiftAssignment.giver_id == user.id, GiftAssignment.receiver_id == user.id)
+    ))
     db.query(GiftAssignment).filter(GiftAssignment.giver_id == user.id).delete()
     db.query(GiftAssignment).filter(GiftAssignment.receiver_id == user.id).delete()
+    db.query(RefreshToken).filter(RefreshToken.user_id == user.id).delete()
     
     # Удаляем связанные токены верификации (используем raw SQL, так как нет модели)
     db.execute(text("DELETE FROM verification_tokens WHERE user_id = :uid"), {"uid": user.id})
@@ -2301,30 +4129,128 @@ async def delete_all_test_users(
     db: Session = Depends(get_db)
 ):
     """Удаление всех тестовых пользователей"""
-    # Находим всех тестовых пользователей
-    test_users = db.query(User).filter(User.is_test == True).all()
+    affected = apply_bulk_user_action(db, "delete", [User.is_test == True])
+    db.commit()
+    principal_cache.clear()
+    public_user_directory.invalidate()
     
-    if not test_users:
+    deleted_count = affected["users"]
+    if not deleted_count:
         return {"message": "Тестовые пользователи не найдены", "deleted_count": 0}
-    
-    # Удаляем всех тестовых пользователей
-    deleted_count = 0
-    for user in test_users:
-        # Удаляем связанные данные (регистрации на мероприятия, подарки и т.д.)
-        db.query(EventRegistration).filter(EventRegistration.user_id == user.id).delete()
-        db.query(GiftAssignment).filter(GiftAssignment.giver_id == user.id).delete()
-        db.query(GiftAssignment).filter(GiftAssignment.receiver_id == user.id).delete()
-        
-        # Удаляем связанные токены верификации (используем raw SQL, так как нет модели)
-        db.execute(text("DELETE FROM verification_tokens WHERE user_id = :uid"), {"uid": user.id})
-        
-        # Удаляем самого пользователя
-        db.delete(user)
-        deleted_count += 1
-    
-    db.commit()
     return {"message": f"Удалено {deleted_count} тестовых пользователей", "deleted_count": deleted_count}
 
+# Массовые операции над пользователями
+verification_tokens_table = table("verification_tokens", column("user_id"))
+BULK_USER_ACTIONS = ("block", "unblock", "promote", "demote", "delete")
+# Размер пачки id в одном IN (...): старые сборки SQLite ограничивают число параметров 999
+BULK_ID_CHUNK_SIZE = 500
+
+def bulk_user_conditions(operation: BulkUserOperation, exclude_user_id: int | None) -> list:
+    """Условия отбора пользователей для массовой операции; список id разбивается на пачки"""
+    base = []
+    user_filter = operation.filter
+    if user_filter is not None:
+        if user_filter.role is not None:
+            base.append(User.role == user_filter.role)
+        if user_filter.is_active is not None:
+            base.append(User.is_active == user_filter.is_active)
+        if user_filter.gwars_verified is not None:
+            base.append(User.gwars_verified == user_filter.gwars_verified)
+        if user_filter.is_test is not None:
+            base.append(User.is_test == user_filter.is_test)
+        if user_filter.profile_completed is not None:
+            base.append(User.profile_completed == user_filter.profile_completed)
+    if exclude_user_id is not None:
+        base.append(User.id != exclude_user_id)
+    
+    if operation.user_ids is None:
+        return [and_(*base)]
+    ids = list(dict.fromkeys(operation.user_ids))
+    return [
+        and_(User.id.in_(ids[i:i + BULK_ID_CHUNK_SIZE]), *base)
+        for i in range(0, len(ids), BULK_ID_CHUNK_SIZE)
+    ]
+
+def apply_bulk_user_action(db: Session, action: str, conditions: list, reason: str | None = None) -> dict:
+    """Выполняет действие одним UPDATE/DELETE на таблицу для каждого условия; коммит — на вызывающем коде"""
+    affected = {}
+
+    def add(table_name: str, count: int):
+        affected[table_name] = affected.get(table_name, 0) + count
+
+    for condition in conditions:
+        if action == "delete":
+            target_ids = select(User.id).where(condition)
+            add("event_registrations", delete_user_registrations(db, target_ids))
+            bump_assignment_versions(db.connection(), assignment_user_ids(
+                GiftAssignment.giver_id.in_(target_ids) | GiftAssignment.receiver_id.in_(target_ids)
+            ))
+            add("gift_assignments", db.query(GiftAssignment).filter(
+                GiftAssignment.giver_id.in_(target_ids) | GiftAssignment.receiver_id.in_(target_ids)
+            ).delete(synchronize_session=False))
+            add("refresh_tokens", db.query(RefreshToken).filter(
+                RefreshToken.user_id.in_(target_ids)
+            ).delete(synchronize_session=False))
+            # Для verification_tokens нет модели — используем легковесное описание таблицы
+            add("verification_tokens", db.execute(
+                delete(verification_tokens_table).where(verification_tokens_table.c.user_id.in_(target_ids))
+            ).rowcount)
+            add("users", db.query(User).filter(condition).delete(synchronize_session=False))
+        else:
+            if action == "block":
+                values = {User.is_active: False, User.block_reason: reason}
+            elif action == "unblock":
+                values = {User.is_active: True, User.block_reason: None}
+            elif action == "promote":
+                values = {User.role: "admin"}
+            else:
+                values = {User.role: "user"}
+            add("users", db.query(User).filter(condition).update(values, synchronize_session=False))
+            if action == "block":
+                add("refresh_tokens", db.query(RefreshToken).filter(
+                    RefreshToken.user_id.in_(select(User.id).where(condition)),
+                    RefreshToken.revoked == False
+                ).update({RefreshToken.revoked: True}, synchronize_session=False))
+    return affected
+
+@app.post("/admin/users/bulk")
+async def bulk_user_operation(
+    operation: BulkUserOperation,
+    current_admin: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """Массовая операция над пользователями по списку id и/или фильтру (только для администраторов)
+    
+    Каждое действие выполняется set-based запросами в одной транзакции.
+    Текущий администратор в выборку не попадает.
+    """
+    if operation.action not in BULK_USER_ACTIONS:
+        raise HTTPException(status_code=400, detail=f"Неизвестное действие. Допустимые: {', '.join(BULK_USER_ACTIONS)}")
+    has_filter = operation.filter is not None and any(
+        value is not None for value in operation.filter.model_dump().values()
+    )
+    if operation.user_ids is None and not has_filter:
+        raise HTTPException(status_code=400, detail="Укажите список пользователей или фильтр")
+    if operation.action == "block" and not operation.reason:
+        raise HTTPException(status_code=400, detail="Укажите причину блокировки")
+    if operation.user_ids == []:
+        return {"action": operation.action, "affected": {"users": 0}}
+    
+    # Себя разблокировать можно, остальные действия над собой запрещены
+    exclude_user_id = None if operation.action == "unblock" else current_admin.id
+    conditions = bulk_user_conditions(operation, exclude_user_id)
+    try:
+        affected = apply_bulk_user_action(db, operation.action, conditions, operation.reason)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Ошибка массовой операции: {str(e)}")
+    # Массовые запросы идут в обход событий ORM
+    principal_cache.clear()
+    if operation.action == "delete":
+        public_user_directory.invalidate()
+    return {"action": operation.action, "affected": affected}
+
 @app.put("/auth/profile")
 async def update_user_profile(
     profile_data: ProfileUpdate,
@@ -2339,10 +4265,7 @@ async def update_user_profile(
         current_user.email = profile_data.email
     if profile_data.gwars_profile_url is not None:
         # Проверяем уникальность ссылки на игровой профиль
-        existing_user = db.query(User).filter(
-            User.gwars_profile_url == profile_data.gwars_profile_url,
-            User.id != current_user.id
-        ).first()
+        existing_user = find_gwars_profile_owner(db, profile_data.gwars_profile_url, current_user.id)
         
         if existing_user:
             raise HTTPException(
@@ -2395,10 +4318,7 @@ async def generate_verification_token(
         raise HTTPException(status_code=400, detail="URL профиля не указан")
     
     # Проверяем уникальность ссылки на игровой профиль
-    existing_user = db.query(User).filter(
-        User.gwars_profile_url == profile_url,
-        User.id != current_user.id
-    ).first()
+    existing_user = find_gwars_profile_owner(db, profile_url, current_user.id)
     
     if existing_user:
         masked_email = mask_email(existing_user.email)
@@ -2446,10 +4366,7 @@ async def verify_gwars_token(
         # Ищем токен в тексте страницы
         if verification_token in response.text:
             # Проверяем уникальность ссылки на игровой профиль
-            existing_user = db.query(User).filter(
-                User.gwars_profile_url == profile_url,
-                User.id != current_user.id
-            ).first()
+            existing_user = find_gwars_profile_owner(db, profile_url, current_user.id)
             
             if existing_user:
                 raise HTTPException(
@@ -2583,26 +4500,46 @@ async def cross_server_login(
         level_int = int(level) if level else 0
         synd_int = int(float(synd)) if synd else 0
         
+        # Набор подписанных параметров: по нему сверяем повторный вход с тем же sign4
+        signed_params = (name, user_id_int, level_int, synd_int, has_passport, has_mobile, old_passport, sign, sign2, sign3)
+        cached_login = cross_server_replay_cache.get(sign4)
+        
+        if cached_login is not None:
+            if CROSS_SERVER_REJECT_REPLAY:
+                raise HTTPException(status_code=403, detail="Ссылка для входа уже использована")
+            cached_params, cached_user_id = cached_login
+            if cached_params != signed_params:
+                raise HTTPException(status_code=403, detail="Неверная подпись sign4 или истек срок действия")
+            # Подписи уже проверены сегодня и данные пользователя записаны — только выдаем токены
+            db_user = db.query(User).filter(User.id == cached_user_id).first()
+            if db_user:
+                tokens = issue_session_tokens(db_user, db)
+                return {
+                    "success": True,
+                    "message": "Успешный вход через GWars",
+                    **tokens
+                }
+        
         # Проверка подписи sign (md5(pass + user_name + user_user_id))
         expected_sign = hashlib.md5(f"{CROSS_SERVER_PASSWORD}{name}{user_id_int}".encode()).hexdigest()
-        if sign != expected_sign:
+        if not hmac.compare_digest(str(sign), expected_sign):
             raise HTTPException(status_code=403, detail="Неверная подпись sign")
         
         # Проверка подписи sign2 (md5(pass + user_fighter_level + round(user_main_synd) + user_id))
         expected_sign2 = hashlib.md5(f"{CROSS_SERVER_PASSWORD}{level_int}{synd_int}{user_id_int}".encode()).hexdigest()
-        if sign2 != expected_sign2:
+        if not hmac.compare_digest(str(sign2), expected_sign2):
             raise HTTPException(status_code=403, detail="Неверная подпись sign2")
         
         # Проверка подписи sign3 (substr(md5(pass + user_name + user_id + has_passport + has_mobile + old_passport), 0, 10))
         expected_sign3 = hashlib.md5(f"{CROSS_SERVER_PASSWORD}{name}{user_id_int}{has_passport}{has_mobile}{old_passport}".encode()).hexdigest()[:10]
-        if sign3 != expected_sign3:
+        if not hmac.compare_digest(str(sign3), expected_sign3):
             raise HTTPException(status_code=403, detail="Неверная подпись sign3")
         
         # Проверка подписи sign4 (substr(md5(strftime("%Y-%m-%d") + sign3 + pass), 0, 10))
         from datetime import date
         today_str = date.today().strftime("%Y-%m-%d")
         expected_sign4 = hashlib.md5(f"{today_str}{sign3}{CROSS_SERVER_PASSWORD}".encode()).hexdigest()[:10]
-        if sign4 != expected_sign4:
+        if not hmac.compare_digest(str(sign4), expected_sign4):
             raise HTTPException(status_code=403, detail="Неверная подпись sign4 или истек срок действия")
         
         # Все подписи верны, ищем или создаем пользователя
@@ -2615,54 +4552,57 @@ async def cross_server_login(
             email = f"gwars_{user_id_int}_{name.lower().replace(' ', '_')}@gwars.local"
             
             # Проверяем, нет ли пользователя с таким email
-            existing_user = db.query(User).filter(User.email == email).first()
-            if existing_user:
-                # Обновляем существующего пользователя
-                existing_user.gwars_user_id = user_id_int
-                existing_user.gwars_nickname = name
-                existing_user.gwars_verified = True
-                db.commit()
-                db.refresh(existing_user)
-                db_user = existing_user
+            db_user = db.query(User).filter(User.email == email).first()
+            if db_user:
+                # Привязываем существующего пользователя к GWars
+                db_user.gwars_user_id = user_id_int
             else:
-                # Создаем нового пользователя
+                # Создаем нового пользователя (вход только через GWars, пароль не задан)
                 name_from_email = name.lower().replace(' ', '_')
+                # Персонаж мог быть указан вручную другим аккаунтом — ссылку тогда не занимаем
+                gwars_url = f"https://www.gwars.io/info.php?id={user_id_int}"
+                if find_gwars_profile_owner(db, gwars_url, 0):
+                    gwars_url = None
                 db_user = User(
                     email=email,
-                    hashed_password=get_password_hash(token_urlsafe(32)),  # Случайный пароль
+                    hashed_password=UNUSABLE_PASSWORD,
                     name=name_from_email,
                     wishlist="",
                     role="user",
                     profile_completed=False,
-                    gwars_profile_url=f"https://www.gwars.io/info.php?id={user_id_int}",
+                    gwars_profile_url=gwars_url,
                     gwars_nickname=name,
                     gwars_user_id=user_id_int,
                     gwars_verified=True,
                     avatar_seed=f"{name_from_email}_{email}_{datetime.utcnow().timestamp()}"
                 )
                 db.add(db_user)
-                db.commit()
-                db.refresh(db_user)
-        else:
-            # Обновляем данные пользователя из GWars
+                # Нужен id для токенов; коммит — один, вместе с refresh-токеном
+                db.flush()
+        
+        # Обновляем данные пользователя из GWars только если они изменились
+        if db_user.gwars_nickname != name:
             db_user.gwars_nickname = name
+        if not db_user.gwars_verified:
             db_user.gwars_verified = True
-            if not db_user.gwars_profile_url:
-                db_user.gwars_profile_url = f"https://www.gwars.io/info.php?id={user_id_int}"
-            db.commit()
-            db.refresh(db_user)
+        if not db_user.gwars_profile_url:
+            gwars_url = f"https://www.gwars.io/info.php?id={user_id_int}"
+            if not find_gwars_profile_owner(db, gwars_url, db_user.id):
+                db_user.gwars_profile_url = gwars_url
         
-        # Создаем JWT токен для пользователя
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": db_user.email}, expires_delta=access_token_expires
-        )
+        # Создаем JWT токены для пользователя (в той же транзакции, что и изменения пользователя)
+        db_user_id = db_user.id
+        tokens = issue_session_tokens(db_user, db)
+        
+        # sign4 действует до конца текущих суток
+        now_local = datetime.now()
+        seconds_until_midnight = (datetime.combine(now_local.date() + timedelta(days=1), datetime.min.time()) - now_local).total_seconds()
+        cross_server_replay_cache.set(sign4, (signed_params, db_user_id), seconds_until_midnight)
         
         return {
             "success": True,
             "message": "Успешный вход через GWars",
-            "access_token": access_token,
-            "token_type": "bearer"
+            **tokens
         }
         
     except ValueError as e:
@@ -3011,27 +4951,11 @@ async def get_public_settings(db: Session = Depends(get_db)):
     settings_dict = {}
     for setting in settings:
         settings_dict[setting.key] = setting.value
+    # Фронтенд подключается к SSE-потоку мероприятия, только если он включен на сервере
+    settings_dict['event_stream_enabled'] = EVENT_STREAM_ENABLED
     
     return settings_dict
 
-@app.get("/users/")
-async def get_public_users(db: Session = Depends(get_db)):
-    """Получение публичного списка пользователей с игровой информацией"""
-    users = db.query(User).all()
-    
-    public_users = []
-    for user in users:
-        public_users.append({
-            "id": user.id,
-            "gwars_nickname": user.gwars_nickname,
-            "gwars_profile_url": user.gwars_profile_url,
-            "gwars_verified": user.gwars_verified,
-            "avatar_seed": user.avatar_seed,
-            "created_at": user.created_at
-        })
-    
-    return public_users
-
 # API endpoint для автодополнения адресов через Dadata
 @app.post("/api/suggest-address")
 async def suggest_address(
@@ -3581,7 +5505,7 @@ async def send_telegram_notification(
             raise HTTPException(status_code=400, detail="Telegram бот не настроен или неактивен")
         
         # Создаем экземпляр бота
-        telegram_bot = TelegramBot(bot_settings.bot_token)
+        telegram_bot = TelegramBotClient(bot_settings.bot_token)
         
         # Получаем список подписанных пользователей
         telegram_users = db.query(TelegramUser).filter(
@@ -3619,13 +5543,8 @@ async def send_telegram_notification(
         db.close()
 
 
-@app.post("/admin/telegram/send-event-notification/{event_id}")
-async def send_event_notification(
-    event_id: int,
-    notification_type: str,
-    current_user: User = Depends(get_current_admin_user)
-):
-    """Отправить уведомление о мероприятии"""
+def deliver_event_notification(event_id: int, notification_type: str) -> dict:
+    """Рассылает уведомление о мероприятии всем подписчикам (блокирующие запросы к Telegram)"""
     db = SessionLocal()
     try:
         # Получаем мероприятие
@@ -3639,7 +5558,7 @@ async def send_event_notification(
             raise HTTPException(status_code=400, detail="Telegram бот не настроен или неактивен")
         
         # Создаем экземпляр бота
-        telegram_bot = TelegramBot(bot_settings.bot_token)
+        telegram_bot = TelegramBotClient(bot_settings.bot_token)
         
         # Получаем список подписанных пользователей
         telegram_users = db.query(TelegramUser).filter(
@@ -3674,15 +5593,253 @@ async def send_event_notification(
             "failed": results["failed"],
             "errors": results["errors"]
         }
-        
     except HTTPException:
         raise
-    except Exception as e:
+    except Exception:
         db.rollback()
-        raise HTTPException(status_code=500, detail=f"Ошибка отправки уведомлений: {str(e)}")
+        raise
     finally:
         db.close()
 
+# Фоновая рассылка: один поток, уведомления уходят по очереди и не держат обработчики запросов
+telegram_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="telegram")
+
+def enqueue_event_notification(event_id: int, notification_type: str):
+    def job():
+        try:
+            result = deliver_event_notification(event_id, notification_type)
+            print(f"Уведомление {notification_type} для мероприятия {event_id}: {result.get('sent', 0)} отправлено")
+        except HTTPException as e:
+            print(f"Уведомление {notification_type} для мероприятия {event_id} не отправлено: {e.detail}")
+        except Exception as e:
+            print(f"Ошибка рассылки {notification_type} для мероприятия {event_id}: {e}")
+    return telegram_executor.submit(job)
+
+@app.post("/admin/telegram/send-event-notification/{event_id}")
+async def send_event_notification(
+    event_id: int,
+    notification_type: str,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Отправить уведомление о мероприятии"""
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            telegram_executor, deliver_event_notification, event_id, notification_type
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка отправки уведомлений: {str(e)}")
+
+
+# Планировщик фаз мероприятий
+# Граница фазы -> тип уведомления TelegramBot.send_event_notification (None — без уведомления)
+EVENT_PHASE_NOTIFICATIONS = {
+    "preregistration_start": "preregistration_started",
+    "registration_start": "registration_started",
+    "registration_ending_soon": "registration_ending_soon",
+    "registration_end": "event_ended",
+    "event_start": None,
+}
+
+class EventScheduler:
+    """Min-heap ближайших границ фаз мероприятий; задача спит до ближайшей границы и вызывает хуки.
+
+    Хуки: сброс кэша /events/current, уведомление в Telegram и (опционально) генерация назначений
+    после закрытия регистрации. В нескольких воркерах работает только тот, кто захватил файл блокировки
+    (без fcntl — кто держит аренду строки scheduler_leases).
+    """
+
+    def __init__(self, lock_path: str, reload_seconds: int, ending_soon_hours: float, notify: bool, auto_assign: bool):
+        self.lock_path = lock_path
+        self.reload_seconds = max(1, reload_seconds)
+        self.ending_soon = timedelta(hours=ending_soon_hours) if ending_soon_hours > 0 else None
+        self.notify = notify
+        self.auto_assign = auto_assign
+        self._lock_file = None
+        self._lease_owner = f"{socket.gethostname()}:{os.getpid()}:{token_hex(4)}"
+        self.leader = False
+        self._heap = []
+        self._horizon = None  # границы до этого момента уже обработаны
+        self._wakeup = None
+        self._task = None
+        self.fired = 0
+        self.last_fired = None
+
+    def boundary(self, event: Event, phase: str) -> datetime | None:
+        if phase == "registration_ending_soon":
+            if self.ending_soon is None or not event.registration_end:
+                return None
+            return event.registration_end - self.ending_soon
+        return getattr(event, phase)
+
+    def acquire_leadership(self) -> bool:
+        """Захватывает или продлевает право быть ведущим; вызывается перед каждым перечитыванием"""
+        if fcntl is None:
+            self.leader = self.renew_lease()
+            return self.leader
+        if self._lock_file is None:
+            lock_file = open(self.lock_path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        self.leader = True
+        return True
+
+    def renew_lease(self) -> bool:
+        # Аренду берем, если она наша или истекла; срок — несколько периодов перечитывания
+        now = datetime.utcnow()
+        statement = sqlite_insert(SchedulerLease).values(
+            name="event_scheduler",
+            owner=self._lease_owner,
+            expires_at=now + timedelta(seconds=self.reload_seconds * 3)
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[SchedulerLease.name],
+            set_={"owner": statement.excluded.owner, "expires_at": statement.excluded.expires_at},
+            where=or_(SchedulerLease.owner == statement.excluded.owner, SchedulerLease.expires_at < now)
+        )
+        with engine.begin() as connection:
+            connection.execute(statement)
+            owner = connection.execute(
+                select(SchedulerLease.owner).where(SchedulerLease.name == "event_scheduler")
+            ).scalar()
+        return owner == self._lease_owner
+
+    def release_lease(self):
+        if fcntl is None and self.leader:
+            with engine.begin() as connection:
+                connection.execute(delete(SchedulerLease).where(
+                    SchedulerLease.name == "event_scheduler",
+                    SchedulerLease.owner == self._lease_owner
+                ))
+        self.leader = False
+
+    def load(self):
+        """Перечитывает из БД все будущие границы активных мероприятий"""
+        db = SessionLocal()
+        try:
+            events = db.query(Event).filter(
+                Event.is_active == True,
+                or_(Event.registration_end > self._horizon, Event.event_start > self._horizon)
+            ).all()
+            heap = []
+            for scheduled_event in events:
+                for phase in EVENT_PHASE_NOTIFICATIONS:
+                    moment = self.boundary(scheduled_event, phase)
+                    if moment and moment > self._horizon:
+                        heap.append((moment, scheduled_event.id, phase))
+            heapq.heapify(heap)
+            self._heap = heap
+        finally:
+            db.close()
+
+    def fire(self, event_id: int, phase: str, moment: datetime):
+        db = SessionLocal()
+        try:
+            scheduled_event = db.query(Event).filter(Event.id == event_id).first()
+            # Мероприятие могли изменить или выключить после загрузки кучи
+            if not scheduled_event or not scheduled_event.is_active or self.boundary(scheduled_event, phase) != moment:
+                return
+            current_event_cache.invalidate()
+            notification_type = EVENT_PHASE_NOTIFICATIONS[phase]
+            if self.notify and notification_type:
+                enqueue_event_notification(event_id, notification_type)
+            if self.auto_assign and phase == "registration_end":
+                try:
+                    generate_gift_assignments(event_id, db)
+                except HTTPException as e:
+                    print(f"Назначения для мероприятия {event_id} не созданы: {e.detail}")
+            self.fired += 1
+            self.last_fired = {"event_id": event_id, "phase": phase, "at": moment.isoformat()}
+        finally:
+            db.close()
+
+    def request_reload(self):
+        """Вызывается после изменения мероприятий в этом процессе"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._horizon = datetime.utcnow()
+        while True:
+            if not await loop.run_in_executor(None, self.acquire_leadership):
+                # Ведущий — другой воркер; проверяем, не освободилась ли блокировка
+                await asyncio.sleep(self.reload_seconds)
+                self._horizon = datetime.utcnow()
+                continue
+            self._wakeup.clear()
+            await loop.run_in_executor(None, self.load)
+            reload_at = loop.time() + self.reload_seconds
+            while True:
+                now = datetime.utcnow()
+                while self._heap and self._heap[0][0] <= now:
+                    moment, event_id, phase = heapq.heappop(self._heap)
+                    try:
+                        await loop.run_in_executor(None, self.fire, event_id, phase, moment)
+                    except Exception as e:
+                        print(f"Ошибка обработки фазы {phase} мероприятия {event_id}: {e}")
+                self._horizon = now
+                timeout = reload_at - loop.time()
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+                if loop.time() >= reload_at:
+                    break
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await asyncio.get_running_loop().run_in_executor(None, self.release_lease)
+
+    def metrics(self) -> dict:
+        next_boundary = self._heap[0] if self._heap else None
+        return {
+            "enabled": EVENT_SCHEDULER_ENABLED,
+            "leader": self.leader,
+            "scheduled": len(self._heap),
+            "next": {"at": next_boundary[0].isoformat(), "event_id": next_boundary[1], "phase": next_boundary[2]} if next_boundary else None,
+            "fired": self.fired,
+            "last_fired": self.last_fired,
+        }
+
+
+event_scheduler = EventScheduler(
+    EVENT_SCHEDULER_LOCK_FILE,
+    EVENT_SCHEDULER_RELOAD_SECONDS,
+    EVENT_SCHEDULER_ENDING_SOON_HOURS,
+    EVENT_SCHEDULER_NOTIFY,
+    EVENT_SCHEDULER_AUTO_ASSIGN
+)
+
+@app.on_event("startup")
+async def start_event_scheduler():
+    if EVENT_SCHEDULER_ENABLED:
+        event_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_event_scheduler():
+    await event_scheduler.stop()
+
 
 # Site Icon API endpoints
 
@@ -3824,6 +5981,16 @@ async def get_current_site_icon():
         db.close()
 
 
+@app.post("/admin/event-stats/rebuild")
+async def rebuild_event_stats_endpoint(
+    current_admin: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """Пересчет счетчиков участников по таблице регистраций (только для администраторов)"""
+    events_count = rebuild_event_stats(db)
+    db.commit()
+    return {"message": "Счетчики участников пересчитаны", "events": events_count}
+
 # Dashboard Statistics API
 @app.get("/admin/dashboard/stats")
 async def get_dashboard_stats(current_user: User = Depends(get_current_admin)):
@@ -3844,9 +6011,12 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_admin)):
         active_events = db.query(Event).filter(Event.is_active == True).count()
         
         # Статистика регистраций на мероприятия
-        total_registrations = db.query(EventRegistration).count()
-        preregistrations = db.query(EventRegistration).filter(EventRegistration.registration_type == "preregistration").count()
-        confirmed_registrations = db.query(EventRegistration).filter(EventRegistration.is_confirmed == True).count()
+        # Берем из event_stats: одна строка на мероприятие вместо подсчета всех регистраций
+        preregistrations, confirmed_registrations = db.query(
+            func.coalesce(func.sum(EventStats.preregistered_count), 0),
+            func.coalesce(func.sum(EventStats.confirmed_count), 0)
+        ).one()
+        total_registrations = preregistrations + confirmed_registrations
         
         # Статистика интересов (с проверкой существования таблицы)
         try:
@@ -3949,17 +6119,48 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_admin)):
     finally:
         db.close()
 
+@app.get("/admin/metrics")
+async def get_runtime_metrics(current_user: User = Depends(get_current_admin)):
+    """Внутренние метрики процесса (пулы, очереди) для администратора"""
+    return {
+        "password_hashing": password_hasher.metrics(),
+        "registration_writer": registration_writer.metrics(),
+        "event_stream": event_stream_bus.metrics(),
+        "event_scheduler": event_scheduler.metrics(),
+    }
+
 # API endpoints для управления назначениями подарков
 @app.post("/admin/events/{event_id}/gift-assignments/generate")
 async def generate_gift_assignments_endpoint(
     event_id: int,
+    options: GiftAssignmentGenerateOptions | None = None,
+    dry_run: bool = Query(False, description="Только рассчитать пары и вернуть токен предпросмотра"),
+    preview_token: str | None = Query(None, description="Сохранить ранее рассчитанный предпросмотр"),
     current_user: User = Depends(get_current_admin_user),
     db: Session = Depends(get_db)
 ):
-    """Генерирует случайные назначения подарков для мероприятия"""
+    """Генерирует случайные назначения подарков для мероприятия
+    
+    Необязательное тело задает ограничения: запрещенные пары, глубину истории, группы.
+    С dry_run=true пары только рассчитываются; затем их можно сохранить как есть, передав preview_token.
+    """
     try:
-        assignments = generate_gift_assignments(event_id, db)
-        return {"message": f"Создано {len(assignments)} назначений подарков", "assignments": len(assignments)}
+        result = generate_gift_assignments(event_id, db, options, dry_run=dry_run, preview_token=preview_token)
+        if dry_run:
+            # Имена для просмотра администратором — одним запросом по всем участникам
+            names = dict(db.query(User.id, func.coalesce(User.gwars_nickname, User.full_name, User.name)).filter(
+                User.id.in_([giver_id for giver_id, _ in result["pairs"]])
+            ).all())
+            return {
+                "preview_token": result["preview_token"],
+                "expires_in": result["expires_in"],
+                "assignments": len(result["pairs"]),
+                "pairs": [
+                    {"giver_id": giver_id, "giver_name": names.get(giver_id), "receiver_id": receiver_id, "receiver_name": names.get(receiver_id)}
+                    for giver_id, receiver_id in result["pairs"]
+                ]
+            }
+        return {"message": f"Создано {len(result['pairs'])} назначений подарков", "assignments": len(result["pairs"])}
     except HTTPException:
         raise
     except Exception as e:
@@ -3968,12 +6169,95 @@ async def generate_gift_assignments_endpoint(
 @app.get("/admin/events/{event_id}/gift-assignments", response_model=list[GiftAssignmentResponse])
 async def get_gift_assignments(
     event_id: int,
+    response: Response,
+    cursor: int | None = Query(None, description="id последнего назначения предыдущей страницы"),
+    limit: int = Query(100, ge=1, le=USER_LIST_MAX_LIMIT),
+    is_approved: bool | None = None,
     current_user: User = Depends(get_current_admin_user),
     db: Session = Depends(get_db)
 ):
-    """Получает все назначения подарков для мероприятия"""
-    assignments_data = get_gift_assignments_with_details(event_id, db)
-    return assignments_data
+    """Получает назначения подарков для мероприятия постранично
+    
+    Курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+    """
+    query = gift_assignment_rows_query(db, event_id, is_approved)
+    if cursor is not None:
+        query = query.filter(GiftAssignment.id > cursor)
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    return [dict(row._mapping) for row in rows]
+
+GIFT_ASSIGNMENT_EXPORT_FIELDS = [
+    "id", "giver_id", "giver_name", "giver_email",
+    "receiver_id", "receiver_name", "receiver_email", "receiver_address",
+    "is_approved", "approved_at",
+]
+GIFT_ASSIGNMENT_EXPORT_CHUNK = 1000
+# С этих символов Excel начинает формулу
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_safe_cell(value):
+    """Экранирует строку, которую Excel принял бы за формулу (CSV formula injection)"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def iter_gift_assignment_chunks(event_id: int, is_approved: bool | None):
+    """Выдает назначения пачками; каждая пачка — короткий отдельный запрос по курсору id"""
+    last_id = 0
+    while True:
+        db = SessionLocal()
+        try:
+            rows = gift_assignment_rows_query(db, event_id, is_approved).filter(
+                GiftAssignment.id > last_id
+            ).limit(GIFT_ASSIGNMENT_EXPORT_CHUNK).all()
+        finally:
+            db.close()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < GIFT_ASSIGNMENT_EXPORT_CHUNK:
+            return
+        last_id = rows[-1].id
+
+@app.get("/admin/events/{event_id}/gift-assignments/export")
+async def export_gift_assignments(
+    event_id: int,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    is_approved: bool | None = None,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Потоковая выгрузка всех назначений мероприятия (CSV или NDJSON) для рассылки подарков"""
+    def ndjson():
+        for rows in iter_gift_assignment_chunks(event_id, is_approved):
+            yield "".join(
+                json.dumps(jsonable_encoder({field: getattr(row, field) for field in GIFT_ASSIGNMENT_EXPORT_FIELDS}), ensure_ascii=False) + "\n"
+                for row in rows
+            )
+    
+    def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM — чтобы Excel открыл кириллицу в UTF-8
+        buffer.write("\ufeff")
+        writer.writerow(GIFT_ASSIGNMENT_EXPORT_FIELDS)
+        for rows in iter_gift_assignment_chunks(event_id, is_approved):
+            for row in rows:
+                writer.writerow([csv_safe_cell(getattr(row, field)) for field in GIFT_ASSIGNMENT_EXPORT_FIELDS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    
+    if format == "ndjson":
+        body, media_type = ndjson(), "application/x-ndjson"
+    else:
+        body, media_type = csv_rows(), "text/csv"
+    filename = f"gift-assignments-{event_id}.{format}"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 @app.put("/admin/gift-assignments/{assignment_id}")
 async def update_gift_assignment(
@@ -4024,46 +6308,99 @@ async def approve_all_gift_assignments(
     current_user: User = Depends(get_current_admin_user),
     db: Session = Depends(get_db)
 ):
-    """Утверждает все назначения подарков для мероприятия"""
-    assignments = db.query(GiftAssignment).filter(
-        GiftAssignment.event_id == event_id,
-        GiftAssignment.is_approved == False
+    """Утверждает все назначения подарков для мероприятия
+    
+    Утверждение — один UPDATE ... RETURNING; уведомления дарителям уходят в фоне.
+    """
+    approved_at = datetime.utcnow()
+    approved = db.execute(
+        update(GiftAssignment)
+        .where(GiftAssignment.event_id == event_id, GiftAssignment.is_approved == False)
+        .values(is_approved=True, approved_at=approved_at, approved_by=current_user.id)
+        .returning(GiftAssignment.id)
+        .execution_options(synchronize_session=False)
     ).all()
     
-    if not assignments:
+    if not approved:
         raise HTTPException(status_code=404, detail="Нет неутвержденных назначений")
     
-    for assignment in assignments:
-        assignment.is_approved = True
-        assignment.approved_at = datetime.utcnow()
-        assignment.approved_by = current_user.id
-    
+    bump_assignment_versions(db.connection(), assignment_user_ids(
+        GiftAssignment.event_id == event_id,
+        GiftAssignment.approved_at == approved_at,
+        GiftAssignment.approved_by == current_user.id
+    ))
     db.commit()
     
-    # Отправляем уведомления пользователям
+    # Отправляем уведомления дарителям
+    enqueue_assignment_notifications(event_id, approved_at, current_user.id)
+    
+    return {"message": f"Утверждено {len(approved)} назначений"}
+
+def deliver_assignment_notifications(event_id: int, approved_at: datetime, approved_by: int) -> dict:
+    """Рассылает дарителям утвержденной пачки их получателей (данные — одним запросом с JOIN)"""
+    db = SessionLocal()
     try:
-        telegram_bot = create_telegram_bot(db)
-        if telegram_bot:
-            for assignment in assignments:
-                # Уведомление дарителю
-                giver = db.query(User).filter(User.id == assignment.giver_id).first()
-                receiver = db.query(User).filter(User.id == assignment.receiver_id).first()
-                event = db.query(Event).filter(Event.id == event_id).first()
-                
-                if giver and receiver and event:
-                    message = f"""🎁 Назначение подарка утверждено!
+        bot_settings = db.query(TelegramBot).first()
+        if not bot_settings or not bot_settings.is_active:
+            return {"sent": 0, "failed": 0}
+        
+        receiver = aliased(User)
+        rows = db.query(
+            TelegramUser.telegram_id,
+            Event.name.label("event_name"),
+            func.coalesce(receiver.full_name, receiver.name).label("receiver_name"),
+            receiver.address.label("receiver_address"),
+        ).select_from(GiftAssignment).join(
+            TelegramUser, and_(TelegramUser.user_id == GiftAssignment.giver_id, TelegramUser.is_active == True)
+        ).join(
+            receiver, receiver.id == GiftAssignment.receiver_id
+        ).join(
+            Event, Event.id == GiftAssignment.event_id
+        ).filter(
+            GiftAssignment.event_id == event_id,
+            GiftAssignment.approved_at == approved_at,
+            GiftAssignment.approved_by == approved_by
+        ).all()
+        if not rows:
+            return {"sent": 0, "failed": 0}
+        
+        telegram_bot = create_telegram_bot(bot_settings.bot_token)
+        if not telegram_bot:
+            return {"sent": 0, "failed": len(rows)}
+        
+        sent, failed = [], 0
+        for row in rows:
+            message = f"""🎁 Назначение подарка утверждено!
 
-Мероприятие: {event.name}
-Вы дарите подарок: {receiver.full_name or receiver.name}
-Адрес получателя: {receiver.address}
+Мероприятие: {row.event_name}
+Вы дарите подарок: {row.receiver_name}
+Адрес получателя: {row.receiver_address}
 
 Пожалуйста, отправьте подарок по указанному адресу."""
-                    
-                    telegram_bot.send_notification_to_user(giver.id, message)
-    except Exception as e:
-        print(f"Ошибка при отправке уведомлений: {e}")
-    
-    return {"message": f"Утверждено {len(assignments)} назначений"}
+            if telegram_bot.send_notification_to_user(row.telegram_id, message):
+                sent.append(row.telegram_id)
+            else:
+                failed += 1
+        
+        # Обновляем время последнего уведомления
+        notified_at = datetime.utcnow()
+        for offset in range(0, len(sent), 500):
+            db.query(TelegramUser).filter(TelegramUser.telegram_id.in_(sent[offset:offset + 500])).update(
+                {TelegramUser.last_notification: notified_at}, synchronize_session=False
+            )
+        db.commit()
+        return {"sent": len(sent), "failed": failed}
+    finally:
+        db.close()
+
+def enqueue_assignment_notifications(event_id: int, approved_at: datetime, approved_by: int):
+    def job():
+        try:
+            result = deliver_assignment_notifications(event_id, approved_at, approved_by)
+            print(f"Уведомления о назначениях мероприятия {event_id}: отправлено {result['sent']}, ошибок {result['failed']}")
+        except Exception as e:
+            print(f"Ошибка при отправке уведомлений: {e}")
+    return telegram_executor.submit(job)
 
 @app.delete("/admin/gift-assignments/{assignment_id}")
 async def delete_gift_assignment(
@@ -4082,73 +6419,54 @@ async def delete_gift_assignment(
 
 @app.get("/user/gift-assignments", response_model=list[GiftAssignmentResponse])
 async def get_user_gift_assignments(
+    request: Request,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Получает назначения подарков для текущего пользователя"""
-    # Назначения где пользователь дарит
-    giver_assignments = db.query(GiftAssignment).filter(
-        GiftAssignment.giver_id == current_user.id,
-        GiftAssignment.is_approved == True
-    ).all()
-    
-    # Назначения где пользователь получает
-    receiver_assignments = db.query(GiftAssignment).filter(
-        GiftAssignment.receiver_id == current_user.id,
-        GiftAssignment.is_approved == True
-    ).all()
+    """Получает утвержденные назначения подарков для текущего пользователя
     
-    result = []
-    
-    # Добавляем назначения где пользователь дарит
-    for assignment in giver_assignments:
-        receiver = db.query(User).filter(User.id == assignment.receiver_id).first()
-        event = db.query(Event).filter(Event.id == assignment.event_id).first()
-        
-        assignment_data = {
-            "id": assignment.id,
-            "event_id": assignment.event_id,
-            "giver_id": assignment.giver_id,
-            "receiver_id": assignment.receiver_id,
-            "is_approved": assignment.is_approved,
-            "created_at": assignment.created_at,
-            "approved_at": assignment.approved_at,
-            "approved_by": assignment.approved_by,
-            "giver_name": current_user.full_name or current_user.name,
-            "giver_email": current_user.email,
-            "receiver_name": receiver.full_name or receiver.name if receiver else None,
-            "receiver_email": receiver.email if receiver else None,
-            "receiver_address": receiver.address if receiver else None,
-            "event_name": event.name if event else None,
-            "assignment_type": "giver"  # Тип назначения
-        }
-        result.append(assignment_data)
-    
-    # Добавляем назначения где пользователь получает
-    for assignment in receiver_assignments:
-        giver = db.query(User).filter(User.id == assignment.giver_id).first()
-        event = db.query(Event).filter(Event.id == assignment.event_id).first()
-        
-        assignment_data = {
-            "id": assignment.id,
-            "event_id": assignment.event_id,
-            "giver_id": assignment.giver_id,
-            "receiver_id": assignment.receiver_id,
-            "is_approved": assignment.is_approved,
-            "created_at": assignment.created_at,
-            "approved_at": assignment.approved_at,
-            "approved_by": assignment.approved_by,
-            "giver_name": giver.full_name or giver.name if giver else None,
-            "giver_email": giver.email if giver else None,
-            "receiver_name": current_user.full_name or current_user.name,
-            "receiver_email": current_user.email,
-            "receiver_address": current_user.address,
-            "event_name": event.name if event else None,
-            "assignment_type": "receiver"  # Тип назначения
-        }
-        result.append(assignment_data)
-    
-    return result
+    Одним запросом UNION ALL: назначения, где пользователь дарит, и где получает.
+    ETag — версия назначений пользователя; пока она не изменилась, ответ 304 без чтения назначений.
+    """
+    version = db.query(UserAssignmentVersion.version).filter(
+        UserAssignmentVersion.user_id == current_user.id
+    ).scalar() or 0
+    etag = f'"{hashlib.sha256(f"{current_user.id}:{version}".encode()).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    def side(user_column):
+        # Каждая половина использует свой индекс (giver_id или receiver_id)
+        giver = aliased(User)
+        receiver = aliased(User)
+        return select(
+            GiftAssignment.id,
+            GiftAssignment.event_id,
+            GiftAssignment.giver_id,
+            GiftAssignment.receiver_id,
+            GiftAssignment.is_approved,
+            GiftAssignment.created_at,
+            GiftAssignment.approved_at,
+            GiftAssignment.approved_by,
+            func.coalesce(giver.full_name, giver.name).label("giver_name"),
+            giver.email.label("giver_email"),
+            func.coalesce(receiver.full_name, receiver.name).label("receiver_name"),
+            receiver.email.label("receiver_email"),
+            receiver.address.label("receiver_address"),
+        ).join(
+            Event, and_(Event.id == GiftAssignment.event_id, Event.deleted_at.is_(None))
+        ).outerjoin(
+            giver, giver.id == GiftAssignment.giver_id
+        ).outerjoin(
+            receiver, receiver.id == GiftAssignment.receiver_id
+        ).where(user_column == current_user.id, GiftAssignment.is_approved == True)
+    
+    assignments = side(GiftAssignment.giver_id).union_all(side(GiftAssignment.receiver_id)).subquery()
+    rows = db.execute(select(assignments).order_by(assignments.c.id)).all()
+    
+    body = json.dumps(jsonable_encoder([dict(row._mapping) for row in rows]), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # Test Users Management
@@ -4162,6 +6480,9 @@ async def generate_test_users(
     if count < 1 or count > 100:
         raise HTTPException(status_code=400, detail="Количество пользователей должно быть от 1 до 100")
     
+    # У всех тестовых пользователей один пароль — хэшируем его один раз
+    hashed_password = await get_password_hash_async(password)
+    
     db = SessionLocal()
     try:
         generated_users = []
@@ -4173,7 +6494,6 @@ async def generate_test_users(
                 continue
                 
             # Создаем нового тестового пользователя
-            hashed_password = pwd_context.hash(password)
             avatar_seed = f"test_user_{i+1}"
             
             new_user = User(
@@ -4228,26 +6548,16 @@ async def delete_test_users(current_user: User = Depends(get_current_admin_user)
     """Удаление всех тестовых пользователей"""
     db = SessionLocal()
     try:
-        # Находим всех тестовых пользователей
-        test_users = db.query(User).filter(User.is_test == True).all()
+        affected = apply_bulk_user_action(db, "delete", [User.is_test == True])
+        db.commit()
+        # Массовое удаление идет в обход событий ORM
+        principal_cache.clear()
+        public_user_directory.invalidate()
         
-        if not test_users:
+        deleted_count = affected["users"]
+        if not deleted_count:
             return {"message": "Тестовые пользователи не найдены", "deleted_count": 0}
         
-        # Удаляем регистрации тестовых пользователей
-        for user in test_users:
-            db.query(EventRegistration).filter(EventRegistration.user_id == user.id).delete()
-            db.query(GiftAssignment).filter(
-                (GiftAssignment.giver_id == user.id) | 
-                (GiftAssignment.receiver_id == user.id)
-            ).delete()
-        
-        # Удаляем самих пользователей
-        deleted_count = len(test_users)
-        db.query(User).filter(User.is_test == True).delete()
-        
-        db.commit()
-        
         return {
             "message": f"Удалено {deleted_count} тестовых пользователей",
             "deleted_count": deleted_count
@@ -4504,6 +6814,7 @@ def generate_unique_verification_token(db: Session, user: User) -> str:
         "dt": datetime.utcnow()
     })
     db.commit()
+    principal_cache.invalidate(user.id)
     return candidate
 
 if __name__ == "__main__":
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Скрипт для пересчета счетчиков участников мероприятий (таблица event_stats)
+Нужен, если регистрации менялись в обход приложения
+"""
+import os
+import sys
+
+# Добавляем текущую директорию в путь, чтобы можно было импортировать main
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import SessionLocal, rebuild_event_stats
+
+def main():
+    db = SessionLocal()
+    try:
+        print("🔄 Пересчет счетчиков участников...")
+        events_count = rebuild_event_stats(db)
+        db.commit()
+        print(f"✅ Счетчики пересчитаны для {events_count} мероприятий")
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Ошибка при пересчете счетчиков: {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
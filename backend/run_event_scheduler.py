@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Отдельный процесс планировщика фаз мероприятий
+Нужен там, где веб-приложение не вызывает startup-хуки (WSGI-адаптер PythonAnywhere):
+запускается как always-on задача и работает, пока ее не остановят
+"""
+import asyncio
+import os
+import sys
+
+# Добавляем текущую директорию в путь, чтобы можно было импортировать main
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import event_scheduler
+
+def main():
+    print("🔄 Планировщик фаз мероприятий запущен")
+    try:
+        asyncio.run(event_scheduler.run())
+    except KeyboardInterrupt:
+        print("✅ Планировщик остановлен")
+
+if __name__ == "__main__":
+    main()
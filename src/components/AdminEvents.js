@@ -3,6 +3,7 @@ import { Typography, Space, Button, Modal, Form, Input, DatePicker, message, Tab
 import { CalendarOutlined, PlusOutlined, EditOutlined, DeleteOutlined, EyeOutlined } from '@ant-design/icons';
 import ProCard from '@ant-design/pro-card';
 import axios from '../utils/axiosConfig';
+import { fetchAllPages } from '../utils/pagination';
 import dayjs from 'dayjs';
 import { useTheme } from '../contexts/ThemeContext';
 
@@ -42,8 +43,8 @@ const AdminEvents = () => {
   const fetchEvents = async () => {
     setLoading(true);
     try {
-      const response = await axios.get('/events/');
-      setEvents(response.data);
+      const eventsList = await fetchAllPages('/events/', { limit: 500 });
+      setEvents(eventsList);
     } catch (error) {
       console.error('Error fetching events:', error);
       message.error('Ошибка загрузки мероприятий');
@@ -25,7 +25,7 @@ import {
   ThunderboltOutlined
 } from '@ant-design/icons';
 import ProCard from '@ant-design/pro-card';
-import axios from '../utils/axiosConfig';
+import { fetchAllPages } from '../utils/pagination';
 import { useTheme } from '../contexts/ThemeContext';
 
 const { Title, Text } = Typography;
@@ -50,8 +50,8 @@ const AdminGiftAssignments = () => {
   const fetchEvents = async () => {
     setLoading(true);
     try {
-      const response = await axios.get('/events/');
-      setEvents(response.data);
+      const eventsList = await fetchAllPages('/events/', { limit: 500 });
+      setEvents(eventsList);
     } catch (error) {
       console.error('Error fetching events:', error);
       message.error('Ошибка загрузки мероприятий');
@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from 'react';
-import { Card, Typography, Space, Button, Modal, Tag, Avatar, Row, Col, Descriptions, App } from 'antd';
+import { Card, Typography, Space, Button, Modal, Tag, Avatar, Row, Col, Descriptions, App, Input } from 'antd';
 import { 
   UserOutlined, 
   PlusOutlined, 
@@ -17,6 +17,7 @@ import ProCard from '@ant-design/pro-card';
 import { Table } from 'antd';
 import { useNavigate } from 'react-router-dom';
 import axios from '../utils/axiosConfig';
+import { fetchAllPages } from '../utils/pagination';
 import { getUserAvatar } from '../utils/avatarUtils';
 import { useAuth } from '../services/AuthService';
 import { useTheme } from '../contexts/ThemeContext';
@@ -41,8 +42,8 @@ const AdminUsers = () => {
   const fetchUsers = async () => {
     setLoading(true);
     try {
-      const response = await axios.get('/users/');
-      setUsers(response.data);
+      const users = await fetchAllPages('/users/', { limit: 500 });
+      setUsers(users);
     } catch (error) {
       message.error('Ошибка при загрузке пользователей');
       console.error('Error fetching users:', error);
@@ -51,6 +52,25 @@ const AdminUsers = () => {
     }
   };
 
+  // Поиск выполняется на сервере по полнотекстовому индексу
+  const handleSearch = async (value) => {
+    const query = value.trim();
+    if (!query) {
+      fetchUsers();
+      return;
+    }
+    setLoading(true);
+    try {
+      const response = await axios.get('/admin/users/search', { params: { q: query, limit: 100 } });
+      setUsers(response.data);
+    } catch (error) {
+      message.error('Ошибка при поиске пользователей');
+      console.error('Error searching users:', error);
+    } finally {
+      setLoading(false);
+    }
+  };
+
   const handleDeleteUser = async (userId) => {
     Modal.confirm({
       title: <span style={{ color: isDark ? '#ffffff' : '#000000' }}>Удалить пользователя</span>,
@@ -404,6 +424,13 @@ const AdminUsers = () => {
         backgroundColor: isDark ? '#1f1f1f' : '#ffffff',
         border: isDark ? '1px solid #404040' : '1px solid #d9d9d9'
       }}>
+        <Input.Search
+          placeholder="Поиск по email, имени, никнейму или ФИО"
+          allowClear
+          enterButton
+          onSearch={handleSearch}
+          style={{ marginBottom: '16px' }}
+        />
         <Table
           columns={columns}
           dataSource={users}
@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { List, Card, Typography, Tag, Spin, Alert } from 'antd';
 import { LinkOutlined, CheckCircleOutlined } from '@ant-design/icons';
-import axios from 'axios';
+import { fetchAllPages } from '../utils/pagination';
 import UserAvatar from './UserAvatar';
 
 const { Title, Text } = Typography;
@@ -19,8 +19,8 @@ const UserList = () => {
     setLoading(true);
     setError(null);
     try {
-      const response = await axios.get('/users/');
-      setUsers(response.data);
+      const users = await fetchAllPages('/users/', { limit: 500 });
+      setUsers(users);
     } catch (error) {
       setError('Ошибка при загрузке списка участников');
       console.error('Error fetching public users:', error);
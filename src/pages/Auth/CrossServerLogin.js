@@ -121,6 +121,9 @@ const CrossServerLogin = () => {
         // Сохраняем токен и обновляем профиль пользователя
         if (response.data.access_token) {
           localStorage.setItem('token', response.data.access_token);
+          if (response.data.refresh_token) {
+            localStorage.setItem('refresh_token', response.data.refresh_token);
+          }
           axios.defaults.headers.common['Authorization'] = `Bearer ${response.data.access_token}`;
           await fetchUserProfile();
         }
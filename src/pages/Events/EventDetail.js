@@ -32,6 +32,65 @@ const EventDetail = () => {
     }
   }, [id]);
 
+  // Живые обновления счетчиков и дат мероприятия через SSE вместо повторных запросов.
+  // Поток может быть выключен на сервере (PythonAnywhere), тогда не подключаемся
+  useEffect(() => {
+    if (!id || typeof EventSource === 'undefined') {
+      return undefined;
+    }
+    let source = null;
+    let cancelled = false;
+    axios.get('/api/settings/public')
+      .then((response) => {
+        if (!cancelled && response.data?.event_stream_enabled) {
+          source = openEventStream();
+        }
+      })
+      .catch((error) => console.error('Error fetching public settings:', error));
+    return () => {
+      cancelled = true;
+      if (source) source.close();
+    };
+  }, [id]);
+
+  const openEventStream = () => {
+    const source = new EventSource(`${axios.defaults.baseURL || ''}/events/${id}/stream`);
+    const setCounts = (preregistered, confirmed) => {
+      setEvent((prev) => prev && {
+        ...prev,
+        preregistered_count: preregistered,
+        confirmed_count: confirmed,
+        participants_count: preregistered + confirmed,
+      });
+    };
+    const applyDelta = (message) => {
+      const { delta } = JSON.parse(message.data);
+      setEvent((prev) => {
+        if (!prev) return prev;
+        const preregistered = (prev.preregistered_count || 0) + delta.preregistered_count;
+        const confirmed = (prev.confirmed_count || 0) + delta.confirmed_count;
+        return { ...prev, preregistered_count: preregistered, confirmed_count: confirmed, participants_count: preregistered + confirmed };
+      });
+    };
+    const applyCounts = (message) => {
+      const data = JSON.parse(message.data);
+      setCounts(data.preregistered_count, data.confirmed_count);
+    };
+    source.addEventListener('snapshot', applyCounts);
+    source.addEventListener('counts', applyCounts);
+    source.addEventListener('joined', applyDelta);
+    source.addEventListener('confirmed', applyDelta);
+    source.addEventListener('event_updated', (message) => {
+      const data = JSON.parse(message.data);
+      setEvent((prev) => prev && { ...prev, ...data, participants_count: data.preregistered_count + data.confirmed_count });
+    });
+    source.addEventListener('event_deleted', () => {
+      source.close();
+      setError('Мероприятие не найдено');
+    });
+    return source;
+  };
+
   const fetchEvent = async () => {
     try {
       setLoading(true);
@@ -4,6 +4,7 @@ import { CalendarOutlined, GiftOutlined, TeamOutlined, ClockCircleOutlined, EyeO
 import ProCard from '@ant-design/pro-card';
 import { useNavigate } from 'react-router-dom';
 import axios from '../../utils/axiosConfig';
+import { fetchAllPages } from '../../utils/pagination';
 import { useTheme } from '../../contexts/ThemeContext';
 
 const { Title, Text, Paragraph } = Typography;
@@ -26,8 +27,8 @@ const EventsPage = () => {
       
       // Простые запросы без Promise.all
       try {
-        const eventsResponse = await axios.get('/events/');
-        setEvents(eventsResponse.data || []);
+        const eventsList = await fetchAllPages('/events/', { limit: 500 });
+        setEvents(eventsList);
       } catch (err) {
         console.error('EventsPage: Error fetching events:', err);
         setEvents([]);
@@ -3,7 +3,7 @@ import { Avatar, Tag, Space, Typography, Card, Row, Col, Spin, List, Button, App
 import { UserOutlined, TeamOutlined, EyeOutlined, LinkOutlined, CheckCircleOutlined, StopOutlined } from '@ant-design/icons';
 import ProCard from '@ant-design/pro-card';
 import { useNavigate, useSearchParams } from 'react-router-dom';
-import axios from '../../utils/axiosConfig';
+import { fetchAllPages } from '../../utils/pagination';
 import { getUserAvatar } from '../../utils/avatarUtils';
 import { useTheme } from '../../contexts/ThemeContext';
 
@@ -42,9 +42,9 @@ const UserListPage = () => {
     try {
       setLoading(true);
       console.log('Fetching users from /users/');
-      const response = await axios.get('/users/');
-      console.log('Users response:', response.data);
-      setUsers(response.data || []);
+      const users = await fetchAllPages('/users/', { limit: 500 });
+      console.log('Users response:', users);
+      setUsers(users);
     } catch (error) {
       console.error('Error fetching users:', error);
       console.error('Error response:', error.response);
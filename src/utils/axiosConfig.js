@@ -20,12 +20,58 @@ axios.interceptors.request.use(
   }
 );
 
+// Обновление access-токена по refresh-токену.
+// Параллельные запросы с истекшим токеном ждут один общий запрос к /auth/refresh.
+let refreshPromise = null;
+
+const refreshAccessToken = () => {
+  if (!refreshPromise) {
+    const refreshToken = localStorage.getItem('refresh_token');
+    refreshPromise = axios
+      .post('/auth/refresh', { refresh_token: refreshToken }, { _skipRefresh: true })
+      .then((response) => {
+        const { access_token, refresh_token } = response.data;
+        localStorage.setItem('token', access_token);
+        localStorage.setItem('refresh_token', refresh_token);
+        axios.defaults.headers.common['Authorization'] = `Bearer ${access_token}`;
+        return access_token;
+      })
+      .finally(() => {
+        refreshPromise = null;
+      });
+  }
+  return refreshPromise;
+};
+
 // Добавляем интерцептор для обработки ошибок
 axios.interceptors.response.use(
   (response) => {
     return response;
   },
-  (error) => {
+  async (error) => {
+    const originalRequest = error.config;
+    const isAuthRequest = ['/auth/login', '/auth/refresh', '/auth/logout'].some(
+      endpoint => originalRequest?.url?.includes(endpoint)
+    );
+
+    // Access-токен истек: пробуем один раз обновить его и повторить запрос
+    if (
+      error.response?.status === 401 &&
+      originalRequest &&
+      !originalRequest._retry &&
+      !originalRequest._skipRefresh &&
+      !isAuthRequest &&
+      localStorage.getItem('refresh_token')
+    ) {
+      originalRequest._retry = true;
+      try {
+        await refreshAccessToken();
+        return axios(originalRequest);
+      } catch (refreshError) {
+        localStorage.removeItem('refresh_token');
+      }
+    }
+
     // Для публичных endpoint (например /users/) не перенаправляем на логин
     const publicEndpoints = ['/users/', '/faq', '/about', '/contacts'];
     const isPublicEndpoint = publicEndpoints.some(endpoint => error.config?.url?.includes(endpoint));
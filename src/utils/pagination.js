@@ -0,0 +1,16 @@
+import axios from './axiosConfig';
+
+// Загружает все страницы списка с курсорной пагинацией.
+// Курсор следующей страницы сервер возвращает в заголовке X-Next-Cursor.
+export const fetchAllPages = async (url, params = {}) => {
+  const items = [];
+  let cursor = null;
+  do {
+    const response = await axios.get(url, {
+      params: cursor ? { ...params, cursor } : params,
+    });
+    items.push(...(response.data || []));
+    cursor = response.headers['x-next-cursor'] || null;
+  } while (cursor);
+  return items;
+};